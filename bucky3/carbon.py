@@ -44,7 +44,7 @@ class CarbonClient(module.MetricsPushProcess, module.TCPConnector):
         return '.'.join(self.translate_token(t) for t in buf)
 
     def process_values(self, recv_timestamp, bucket, values, timestamp, metadata):
-        metadata['bucket'] = bucket
+        metadata = dict(metadata, bucket=bucket)
         for k, v in values.items():
             metadata['value'] = k
             name = self.build_name(metadata.copy())
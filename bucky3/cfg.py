@@ -84,6 +84,27 @@ flush_interval = 10
 # - Example: randomize_startup = False
 
 
+# align_flush
+# - bool, if flushes should happen on wall clock multiples of flush_interval
+# - Optional, default: False
+# - By default, modules flush every flush_interval counting from when they started, so
+#   a 10 secs window may close at :07 on one host and at :03 on another. With align_flush,
+#   source modules close their windows at :00, :10, :20... and timestamp them so, and the
+#   statsd rollups on multiples of their own flush_interval. That way, metrics from many
+#   hosts line up and can be merged or downsampled downstream. It needs hosts with synced
+#   clocks. randomize_startup is ignored, see push_jitter to spread the load on the push side.
+# - Example: align_flush = True
+
+
+# push_jitter
+# - float, max random delay in seconds of the flushes in push modules
+# - Optional, default: 0
+# - influxdb_client, carbon_client and elasticsearch_client flush at a random offset of up
+#   to push_jitter from their schedule (i.e. from the aligned one with align_flush), so that
+#   many hosts with aligned source modules don't all push to the same backend at once.
+# - Example: push_jitter = 2
+
+
 # metadata
 # - dict of str:str, extra metadata injected into metrics
 # - Optional, default: {}
@@ -100,11 +121,37 @@ metadata = {
 # - influxdb_client, carbon_client and elasticsearch_client modules buffer metrics
 #   before pushing them out to the destination host. This param is a safety measure. If for
 #   a reason data doesn't get pushed out and the buffer grows beyond buffer_limit, it is
-#   truncated to buffer_limit / 2.
+#   truncated to buffer_limit / 2 (see buffer_policy).
 #   In any case, buffer_limit is enforced to be at least 100.
 # - Example: buffer_limit = 1000
 
 
+# buffer_size_limit
+# - int, max size of the entries in the output buffer, in bytes (characters, strictly speaking)
+# - Optional, default: None
+# - Same as buffer_limit, but by size. If the buffer grows beyond it, it is truncated to
+#   buffer_size_limit / 2. With self_report on, the buffer size is reported as buffer_size.
+# - Example: buffer_size_limit = 64 * 1024 * 1024
+
+
+# buffer_policy
+# - str, what happens to the entries trimmed from the output buffer
+# - Optional, default: "trim"
+# - With "trim", the entries trimmed off the buffer (see buffer_limit) are dropped. With "spill",
+#   they are written to disk under spill_path and pushed out once the destination host takes
+#   data again, oldest first, after what is in the buffer and at most at spill_replay_rate.
+#   Only applicable to influxdb_client, carbon_client and elasticsearch_client.
+# - Example: buffer_policy = "spill"
+
+
+# spill_replay_rate
+# - int, max number of spilled entries pushed per second
+# - Optional, default: = buffer_limit
+# - See buffer_policy. It keeps a backlog built up during an outage from swamping the destination
+#   host once it is back up.
+# - Example: spill_replay_rate = 5000
+
+
 # chunk_size
 # - int, max number of entries in one write
 # - Optional, default: 300
@@ -120,6 +167,93 @@ metadata = {
 # - Example: chunk_size = 10
 
 
+# eager_flush
+# - bool, if source modules should send metrics on before the flush
+# - Optional, default: False
+# - jsond_server and systemd_journal buffer the metrics as they come in and by default send
+#   them on to the destination modules every flush_interval. With eager_flush, the receiving
+#   thread sends every chunk_size worth of metrics on right away, which keeps bursts from
+#   piling up in memory and evens out the IPC. Note that a destination module that falls
+#   behind then holds up the receiving, see dst_queue_policy.
+# - Example: eager_flush = True
+
+
+# eager_flush_bytes
+# - int, size of the input in bytes after which the buffer is sent on regardless of chunk_size
+# - Optional, default: None
+# - Only used with eager_flush.
+# - Example: eager_flush_bytes = 256 * 1024
+
+
+# ipc_transport
+# - str, how source modules pass metrics on to destination modules, 'pipe' or 'shm'
+# - Optional, default: 'pipe'
+# - Either way, each chunk is encoded once, with marshal (pickle only for values marshal can't
+#   handle, i.e. from a metric_postprocessor) or with the interned encoding if ipc_interning
+#   is on. With 'pipe', the encoded chunks are sent as raw bytes into a pipe per source and
+#   destination module pair. With 'shm', they are written to a shared memory ring buffer per
+#   pair instead and the pipe only carries wakeups, which takes less CPU at high metric rates.
+#   Chunks that don't fit in the ring go through the pipe, so nothing gets lost either way.
+#   It needs Python 3.8+, on older versions pipes are used. Set in source modules.
+# - Example: ipc_transport = 'shm'
+
+
+# ipc_buffer_size
+# - int, size of each shared memory ring buffer in bytes
+# - Optional, default: 8MB
+# - Only used with ipc_transport = 'shm'.
+# - Example: ipc_buffer_size = 32 * 1024 * 1024
+
+
+# ipc_interning
+# - bool, if source modules should send metadata and bucket names by reference
+# - Optional, default: False
+# - Each source module keeps a dictionary of the metadata sets and bucket names it has sent
+#   to destination modules and only sends references to them afterwards, destination modules
+#   keep the mirror dictionary. That takes less CPU and memory on the destination side and
+#   roughly halves the IPC volume, at a slightly higher cost on the source side. The dictionary
+#   is started over every minute, after a restart, a destination module drops what it cannot
+#   decode until then (reported as metrics_undecoded with self_report on). Set in source modules.
+# - Example: ipc_interning = True
+
+
+# dst_queue_policy
+# - str, what a source module does when a destination module falls behind
+# - Optional, default: None
+# - By default, source modules send to destination modules directly, a destination module
+#   that falls behind stalls the flush and so all the other destinations of the source.
+#   With a policy set, each destination gets its own queue of up to dst_queue_limit bytes,
+#   sent out by a separate thread. When the queue is full, "drop_oldest" drops the oldest
+#   chunks of metrics, "drop_newest" the incoming ones and "spill" writes the incoming
+#   ones to disk under spill_path, to be sent once the destination catches up.
+#   With self_report on, the queue size, lag and drops are reported per destination.
+#   Set in source modules.
+# - Example: dst_queue_policy = "drop_oldest"
+
+
+# dst_queue_limit
+# - int, size in bytes of the per destination queues
+# - Optional, default: 16 * 1024 * 1024
+# - See dst_queue_policy. Set in source modules.
+# - Example: dst_queue_limit = 64 * 1024 * 1024
+
+
+# spill_path
+# - str, directory for the metrics spilled to disk
+# - Optional, default: None
+# - Required by the "spill" dst_queue_policy and buffer_policy, each module keeps its spill
+#   files in a subdirectory named after it. The files survive restarts, what was spilled before
+#   is sent once the module is back up.
+# - Example: spill_path = "/var/lib/bucky3/spill"
+
+
+# spill_limit
+# - int, max size in bytes of the spill files per destination (or per module, with buffer_policy)
+# - Optional, default: 1024 * 1024 * 1024
+# - Once reached, the oldest spilled metrics are dropped to make room.
+# - Example: spill_limit = 4 * 1024 * 1024 * 1024
+
+
 # self_report
 # - bool, if modules should produce metrics about themselves
 # - Optional, default: False
@@ -128,7 +262,9 @@ metadata = {
 #   So the self report will be produced no more often than once a minute, but may be produced
 #   less often if the flush period is long. Note, the main module, by design, will not report
 #   anything regardless of the setting. Also, the configured metadata is injected into self
-#   reported metrics just as it would for other type of metrics.
+#   reported metrics just as it would for other type of metrics. The reported schedule_jitter
+#   is the max delay (in seconds) of a flush or self report past its due time, since the
+#   previous report.
 # - Example: self_report = True
 
 
@@ -166,6 +302,17 @@ metadata = {
 #   modules and provide control over traffic generated and data retention.
 
 
+# max_push_latency
+# - float, max delay in seconds before buffered metrics are pushed out
+# - Optional, default: None
+# - By default, influxdb_client, carbon_client and elasticsearch_client push their buffer
+#   out every flush_interval. With max_push_latency set, a separate thread pushes it out
+#   as soon as there is a chunk_size worth of metrics in it, or after max_push_latency
+#   at the latest, so metrics go out within milliseconds under load while still being
+#   batched. After a failed push, it backs off the same way as with flush_interval.
+# - Example: max_push_latency = 0.1
+
+
 # metric_postprocessor
 # - callback, custom metric postprocessor
 # - Optional, default: None
@@ -191,8 +338,8 @@ linuxstats = {
     # - Required
     # - There is no limit on the number of same type modules being run. This finds very
     #   limited application. I.e. you may need duplicated Prometheus exporters running
-    #   on different ports. In extreme cases, you may want to run multiple statsd_server
-    #   instances to make use of multiple cores.
+    #   on different ports. To make use of multiple cores in statsd_server, see its
+    #   workers option rather than running multiple instances of it.
     'module_type': "linux_stats",
 
     # module_inactive
@@ -297,9 +444,27 @@ statsd = {
     # - str, UDP endpoint to bind at
     # - Optional, default: '0.0.0.0:0'
     # - The default will bind to a random local port, most likely you want the typical 8125.
-    #   You can use IP or hostname, port number has to be numeric though.
+    #   You can use IP or hostname, port number has to be numeric though. Set it to None
+    #   to take datagrams on unix_dgram_path only.
     'local_host': '127.0.0.1:8125',
 
+    # unix_dgram_path, path of Unix datagram socket to bind at
+    # - str
+    # - Optional, default: None
+    # - Clients on the same host can send datagrams to this socket, alongside or instead
+    #   of local_host. It is cheaper than going through the loopback IP stack and when
+    #   the module cannot keep up, clients get EAGAIN (or block) rather than their datagrams
+    #   being silently dropped by the kernel. The socket is shared by workers, recv_buffer_size
+    #   applies to it as well. A stale socket file at the path is removed, the socket file
+    #   is removed on exit, too.
+    # - Example: 'unix_dgram_path': '/run/bucky3/statsd.dgram',
+
+    # unix_socket_permissions, file permissions of unix_dgram_path and unix_stream_path
+    # - int
+    # - Optional, default: None
+    # - If None, the permissions are subject to umask of the process.
+    # - Example: 'unix_socket_permissions': 0o660,
+
     # timers_bucket
     # - str, defines the metrics namespace/bucket for StatsD timers
     # - Required
@@ -327,6 +492,56 @@ statsd = {
     #   calculated are: lower, upper, mean, count, count_ps, and stdev.
     'percentile_thresholds': (50, 90, 100),
 
+    # timer_engine, how timer samples are kept and percentiles calculated
+    # - str
+    # - Optional, default: 'sort'
+    # - With 'sort', all samples received within flush_interval are kept and sorted on flush,
+    #   stats are exact but memory and flush time grow with traffic. With 'sketch', samples are
+    #   counted in a quantile sketch (DDSketch) with bounded memory per key. Its percentiles
+    #   (and the upper stats) are estimated within timer_sketch_accuracy relative error, lower
+    #   is exact, count is exact for 100th percentile and mean / stdev are close approximations.
+    #   Sketches are mergeable, i.e. they get merged across workers. With 'numpy', samples are
+    #   kept in compact float arrays and the stats are calculated with NumPy (partitioning instead
+    #   of sorting), the output is the same as with 'sort' (within FP rounding), only faster
+    #   with many samples. If NumPy is not installed, the 'sort' engine is used. With 'select',
+    #   the output is the same, too, but samples are not sorted, percentiles are found with
+    #   quickselect (in linear time), which is faster than 'sort' for large numbers of samples.
+    # - Example: 'timer_engine': 'sketch',
+
+    # timer_sketch_accuracy, relative error of percentiles with the 'sketch' timer_engine
+    # - float
+    # - Optional, default: 0.01
+    # - Example: 'timer_sketch_accuracy': 0.005,
+
+    # timer_sketch_max_bins, max number of bins per key with the 'sketch' timer_engine
+    # - int
+    # - Optional, default: 2048
+    # - This is the upper bound of memory used per key. With the default accuracy, 2048 bins
+    #   cover values ranging across 17 orders of magnitude, so the limit is rarely hit. If it is,
+    #   the bins of lowest values are collapsed (and lose accuracy).
+    # - Example: 'timer_sketch_max_bins': 512,
+
+    # set_engine, how the distinct values of sets are counted
+    # - str
+    # - Optional, default: 'exact'
+    # - With 'exact', all distinct values received within flush_interval are kept, memory grows
+    #   with the cardinality. With 'hll', a key with more than set_hll_threshold distinct values
+    #   switches to a HyperLogLog sketch that takes 2 ** set_hll_precision bytes regardless
+    #   of the cardinality, the counts are then estimated (standard error of 1.6% with the
+    #   default precision). Below the threshold, counts are exact.
+    # - Example: 'set_engine': 'hll',
+
+    # set_hll_precision, precision of HyperLogLog sketches with the 'hll' set_engine
+    # - int
+    # - Optional, default: 12
+    # - Has to be within [4, 18], the standard error of estimates is 1.04 / sqrt(2 ** precision).
+    # - Example: 'set_hll_precision': 14,
+
+    # set_hll_threshold, max number of distinct values counted exactly with the 'hll' set_engine
+    # - int
+    # - Optional, default: 1000
+    # - Example: 'set_hll_threshold': 100,
+
     # histogram_selector, histogram bins for timers
     # - callable
     # - Optional, default: None
@@ -338,6 +553,18 @@ statsd = {
     #   For each bin, the stats calculated are: lower, upper, mean, count, count_ps, and stdev.
     'histogram_selector': lambda metadata: myapp_response_histogram,
 
+    # histogram_bins, declarative histogram bins for timers
+    # - tuple of (dict, tuple) tuples
+    # - Optional, default: None
+    # - Each entry is a metadata match and a list of bin boundaries. The first entry whose
+    #   match dict is a subset of the metric metadata (an empty dict matches everything) wins.
+    #   For boundaries (100, 300), the bins are under_100 (x < 100), under_300 (100 <= x < 300)
+    #   and over_300, the same as with the myapp_response_histogram above. This is a lot
+    #   faster than histogram_selector as no Python code is called per sample, the matching
+    #   is cached per metadata and samples are counted in flat lists. Metrics not matched
+    #   by any entry go to histogram_selector, if one is provided.
+    # - Example: 'histogram_bins': (({'name': 'myapp_response'}, (100, 300)), ({}, (10, 100, 1000))),
+
     # timestamp_window, acceptable time window (in seconds) for custom timestamps
     # - int
     # - Optional, default: 600
@@ -346,6 +573,141 @@ statsd = {
     #   window configured here: now - timestamp_window ... now + timestamp_window
     #   Metrics with custom timestamp outside of the window are ignored.
     # - Example: 'timestamp_window': 60,
+
+    # rollups, additional flush intervals for the same metrics
+    # - list / tuple of dicts
+    # - Optional, default: None
+    # - Each rollup is a dict with flush_interval (in seconds, a multiple of the module
+    #   flush_interval) and optionally destination_modules (by default, the destinations of
+    #   the module). The aggregates of each flush are merged into the rollups, which get flushed
+    #   to their destinations at their own pace. That is, the metrics get parsed only once.
+    #   Percentiles and other stats of timers are calculated across the whole rollup interval,
+    #   note that with 'sort', 'select' or 'numpy' timer_engine it means all the samples are
+    #   kept in memory for the whole interval, 'sketch' is a better fit for long rollups.
+    #   Counters are summed up, sets are joined and gauges take the last value. The rollups
+    #   should go to other destinations than the module or to other buckets, otherwise
+    #   the destinations end up with the same metrics calculated over different intervals.
+    # - Example: 'rollups': ({'flush_interval': 60, 'destination_modules': ('influxdb',)},),
+
+    # key_cache_size, max number of parsed metric names and tags kept in cache
+    # - int
+    # - Optional, default: 10000
+    # - Parsing tags is the most expensive part of handling StatsD lines, while applications
+    #   tend to send the same names and tags over and over again. The parsed names and tags are
+    #   therefore kept in an LRU cache. Lines with custom timestamp bypass the cache. With
+    #   self_report on, key_cache_hits and key_cache_misses are reported, if there are many
+    #   more misses than hits, bump the cache size up. Set it to 0 to disable the cache.
+    #   Note that with the cache on, histogram_selector must not alter the metadata it gets.
+    # - Example: 'key_cache_size': 50000,
+
+    # cardinality_limit, max number of series (distinct tag sets) per metric name
+    # - int
+    # - Optional, default: None
+    # - A tag with unbounded values, i.e. request ID, can explode the number of series
+    #   and with it the memory and flush time of this and downstream modules. With this
+    #   limit, new series of a name that is over its budget within a flush interval are
+    #   folded into a single series of that name, tagged with series=__overflow__.
+    #   With self_report on, series_overflows is reported, as well as the top offending names
+    #   (tagged with overflow_name). Note that with workers, each worker has its own budgets.
+    # - Example: 'cardinality_limit': 1000,
+
+    # cardinality_limit_total, max number of series across all names
+    # - int
+    # - Optional, default: None
+    # - Similar to cardinality_limit, but once over this limit, unknown names all get folded
+    #   into a single series with name __overflow__.
+    # - Example: 'cardinality_limit_total': 100000,
+
+    # cardinality_report_top, number of top offending names reported with self_report
+    # - int
+    # - Optional, default: 10
+    # - Example: 'cardinality_report_top': 3,
+
+    # load_shedding, sample timers, sets and counters when overloaded
+    # - bool
+    # - Optional, default: False
+    # - When a client floods the module, the ingest pins a core and flushes and self reports
+    #   slip. With this on, the CPU use of the module (and its workers) and the fill of the UDP
+    #   receive queues are checked on each flush. Past shedding_cpu_threshold or
+    #   shedding_backlog_threshold, the module takes only every 2nd, 4th, ... sample per series
+    #   for the next interval, down to shedding_min_ratio. Counters are scaled up accordingly,
+    #   timer and set counts are not. Once the load is under half the thresholds, the sampling
+    #   is stepped back the same way. Gauges are never sampled. The sampling ratio in effect
+    #   goes out on each flush in bucket bucky3 as sampling_ratio, tagged with the module name.
+    # - Example: 'load_shedding': True,
+
+    # shedding_cpu_threshold, CPU use that triggers load shedding
+    # - float, fraction of a core per process
+    # - Optional, default: 0.9
+    # - Example: 'shedding_cpu_threshold': 0.75,
+
+    # shedding_backlog_threshold, UDP receive queue fill that triggers load shedding
+    # - float, fraction of the socket receive buffer
+    # - Optional, default: 0.5
+    # - Linux only, see recv_buffer_size below.
+    # - Example: 'shedding_backlog_threshold': 0.25,
+
+    # shedding_min_ratio, the lowest sampling ratio load shedding goes down to
+    # - float
+    # - Optional, default: 0.01
+    # - Example: 'shedding_min_ratio': 0.1,
+
+    # recv_batch_size, max number of datagrams taken off the socket in one go
+    # - int
+    # - Optional, default: 64
+    # - The module waits for a datagram and then drains, without blocking, whatever else
+    #   is already queued up in the socket, up to recv_batch_size datagrams. Such a batch
+    #   is then parsed in one pass. Under bursty traffic this saves a lot of wakeups and
+    #   per datagram overhead. Setting it to 1 disables batching.
+    # - Example: 'recv_batch_size': 256,
+
+    # recv_buffer_size, socket receive buffer size (SO_RCVBUF) in bytes
+    # - int
+    # - Optional, default: None
+    # - If None, the system default is used. If the module cannot keep up with bursts,
+    #   the kernel drops datagrams when the buffer fills up. Note that Linux caps this value
+    #   at net.core.rmem_max. With self_report on, the module reports datagrams_received,
+    #   bytes_received, bytes_received_rate (bytes/s since the previous report) and parse_errors,
+    #   and, on Linux, datagrams_dropped which is the number of datagrams the kernel dropped
+    #   on the socket and recv_queue_bytes, the bytes waiting in the socket receive queue.
+    #   Use those to size the buffer. datagrams_truncated counts the Unix datagrams dropped
+    #   for being bigger than 64KB. The same goes for jsond_server.
+    # - Example: 'recv_buffer_size': 4 * 1024 * 1024,
+
+    # tcp_local_host, TCP endpoint to listen at
+    # - str
+    # - Optional, default: None
+    # - On top of UDP, the module can take newline separated StatsD lines over TCP connections.
+    #   Clients sending a lot of data can keep a connection open and avoid the per datagram
+    #   overhead, and unlike with UDP, nothing gets silently dropped. All connections are served
+    #   by a single thread (of the main process, not the workers). With self_report on,
+    #   bytes_received and lines_received are reported per connection.
+    # - Example: 'tcp_local_host': '127.0.0.1:8125',
+
+    # unix_stream_path, path of Unix stream socket to listen at
+    # - str
+    # - Optional, default: None
+    # - Same as tcp_local_host, but for local clients. A stale socket file at the path is removed,
+    #   the socket file is removed on exit, too.
+    # - Example: 'unix_stream_path': '/run/bucky3/statsd.sock',
+
+    # stream_max_line_length, max length of lines received over stream connections
+    # - int
+    # - Optional, default: 65535
+    # - Connections sending longer lines get closed.
+    # - Example: 'stream_max_line_length': 4096,
+
+    # workers, number of processes receiving and parsing StatsD traffic
+    # - int
+    # - Optional, default: 1
+    # - With workers > 1, the module forks workers - 1 extra processes, each binding its own
+    #   socket to local_host (with SO_REUSEPORT, so the kernel spreads the traffic across them).
+    #   On flush, the partial aggregates from all workers are merged, so there is still one
+    #   correct series per key, i.e. percentiles are calculated over all samples and counters
+    #   are summed up. Gauges are not summed, the value most recently merged wins. Note that
+    #   local_host needs an explicit port for this to work. Only worth it if a single core
+    #   cannot keep up with the traffic.
+    # - Example: 'workers': 4,
 }
 
 
@@ -368,6 +730,9 @@ jsond = {
     # - See local_host description statsd, you most likely want to specify this option.
     'local_host': '127.0.0.1:8181',
 
+    # unix_dgram_path, unix_socket_permissions, recv_batch_size, recv_buffer_size
+    # - See statsd module.
+
     # timestamp_window, acceptable time window (in seconds) for custom timestamps
     # - int
     # - Optional, default: 600
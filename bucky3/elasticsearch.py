@@ -80,8 +80,8 @@ class ElasticsearchClient(module.MetricsPushProcess, module.TCPConnector):
         return super().flush(system_timestamp)
 
     def process_values(self, recv_timestamp, bucket, values, timestamp, metadata):
-        self.merge_dict(metadata)
         self.merge_dict(values, metadata)
+        self.merge_dict(values)
         timestamp = timestamp or recv_timestamp
         # ES parses the following as 'epoch_millis', see:
         # https://www.elastic.co/guide/en/elasticsearch/reference/current/date.html
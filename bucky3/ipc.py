@@ -0,0 +1,253 @@
+
+
+import time
+import struct
+import pickle
+import marshal
+import multiprocessing
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+
+MARSHAL = b'm'[0]
+PICKLE = b'p'[0]
+INTERNED = b'i'[0]
+
+
+def encode(obj):
+    # Chunks are lists of tuples of plain types, marshal handles those faster and more compactly
+    # than pickle. Anything else, i.e. what a metric_postprocessor came up with, goes via pickle.
+    try:
+        return b'm' + marshal.dumps(obj)
+    except ValueError:
+        return b'p' + pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+
+def decode(data, decoder=None):
+    if data[0] == MARSHAL:
+        return marshal.loads(data[1:])
+    if data[0] == INTERNED:
+        if decoder is None:
+            raise ValueError("Interned encoding needs a decoder")
+        return decoder.decode(data[1:])
+    if data[0] == PICKLE:
+        return pickle.loads(data[1:])
+    raise ValueError("Unknown encoding")
+
+
+def recv(conn, decoder=None):
+    # Pipes carry one encoded chunk per message, the shared memory ends decode what they get themselves.
+    if isinstance(conn, ShmReceiver):
+        return conn.recv(decoder)
+    return decode(conn.recv_bytes(), decoder)
+
+
+class Encoder:
+    """
+    Encodes chunks of (bucket, values, timestamp, metadata) with buckets and metadata replaced
+    by references to a session dictionary, only the entries new to the dictionary go along.
+
+    Each sending end has its own encoder and each receiving end its own Decoder, which mirrors
+    the dictionary. A decoder that missed a part of the session, i.e. because its process got
+    restarted, drops what it can't decode until the next session. Sessions start over when
+    the dictionary gets full or older than max_age seconds. Chunks of other shapes or with
+    values marshal can't handle are passed on with the plain encoding.
+    """
+
+    def __init__(self, max_entries=65536, max_age=60):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.reset()
+
+    def reset(self):
+        self.refs = {}
+        self.session_timestamp = time.perf_counter()
+
+    def encode(self, chunk):
+        if len(self.refs) >= self.max_entries or time.perf_counter() - self.session_timestamp > self.max_age:
+            self.reset()
+        refs = self.refs
+        base, definitions, entries = len(refs), [], []
+        try:
+            for bucket, values, timestamp, metadata in chunk:
+                bucket_ref = refs.get(bucket)
+                if bucket_ref is None:
+                    bucket_ref = refs[bucket] = base + len(definitions)
+                    definitions.append(bucket)
+                metadata_key = tuple(metadata.items())
+                metadata_ref = refs.get(metadata_key)
+                if metadata_ref is None:
+                    metadata_ref = refs[metadata_key] = base + len(definitions)
+                    definitions.append(metadata)
+                entries.append((bucket_ref, values, timestamp, metadata_ref))
+            return b'i' + marshal.dumps((base, definitions, entries))
+        except (ValueError, TypeError, AttributeError):
+            # The definitions made so far never make it to the decoder, so start over.
+            self.reset()
+            return encode(chunk)
+
+
+def strip(data):
+    # Returns (base, data) with the metrics taken out of an interned chunk, None if there is
+    # nothing left. A chunk can be dropped, but the entries it adds to the dictionary must still
+    # make it to the decoder, or nothing that follows in the session can be decoded.
+    if data[0] != INTERNED:
+        return None
+    base, definitions, entries = marshal.loads(data[1:])
+    if not definitions:
+        return None
+    return base, b'i' + marshal.dumps((base, definitions, []))
+
+
+class Decoder:
+    # Decoded metadata dicts are shared by all the metrics referring to them, they must not be altered.
+    def __init__(self):
+        self.table = None
+        self.dropped = 0
+
+    def decode(self, data):
+        base, definitions, entries = marshal.loads(data)
+        table = self.table
+        if base == 0:
+            table = self.table = []
+        elif table is None or base != len(table):
+            self.table = None
+            self.dropped += len(entries)
+            return []
+        table.extend(definitions)
+        return [(table[b], values, timestamp, table[m]) for b, values, timestamp, m in entries]
+
+
+class ShmRing:
+    """
+    Single producer, single consumer ring buffer of length prefixed records in shared memory.
+
+    The header holds the cumulative write and read positions, each one is only ever updated
+    by one side. Records are never split, if one doesn't fit in before the end of the buffer,
+    the rest of it is skipped (marked with WRAP if there is room for it) and the record goes
+    at the start. That way the reader can decode records in place, without copying them out.
+    The segment has to be created before the processes using it are forked.
+    """
+
+    HEADER = 64
+    WRAP = 0xffffffff
+
+    def __init__(self, size):
+        self.shm = shared_memory.SharedMemory(create=True, size=self.HEADER + size)
+        self.buf = self.shm.buf
+        self.capacity = size
+        struct.pack_into('QQ', self.buf, 0, 0, 0)
+
+    def write(self, data):
+        buf, capacity = self.buf, self.capacity
+        write_pos, read_pos = struct.unpack_from('QQ', buf, 0)
+        offset = write_pos % capacity
+        tail = capacity - offset
+        need = 4 + len(data)
+        padding = tail if tail < need else 0
+        if padding + need > capacity - (write_pos - read_pos):
+            return None
+        if padding:
+            if tail >= 4:
+                struct.pack_into('I', buf, self.HEADER + offset, self.WRAP)
+            offset = 0
+        start = self.HEADER + offset
+        struct.pack_into('I', buf, start, len(data))
+        buf[start + 4:start + need] = data
+        write_pos += padding + need
+        struct.pack_into('Q', buf, 0, write_pos)
+        return write_pos
+
+    def read(self, limit):
+        # Returns a view of the next record and the read position past it, or None
+        # if there is nothing before limit. The position is to be committed once
+        # the record is no longer needed.
+        buf, capacity = self.buf, self.capacity
+        read_pos = struct.unpack_from('Q', buf, 8)[0]
+        if read_pos >= limit:
+            return None
+        offset = read_pos % capacity
+        tail = capacity - offset
+        if tail < 4 or struct.unpack_from('I', buf, self.HEADER + offset)[0] == self.WRAP:
+            read_pos += tail
+            offset = 0
+        start = self.HEADER + offset
+        size = struct.unpack_from('I', buf, start)[0]
+        return buf[start + 4:start + 4 + size], read_pos + 4 + size
+
+    def commit(self, read_pos):
+        struct.pack_into('Q', self.buf, 8, read_pos)
+
+    def unlink(self):
+        self.buf.release()
+        self.shm.close()
+        self.shm.unlink()
+
+
+class ShmSender:
+    # The sending end, what goes into the ring is announced over the pipe with the write position
+    # past it. Data that doesn't fit in the ring goes through the pipe, right after the position,
+    # the pipe then blocks the sender until the reader catches up, just as plain pipes do.
+    def __init__(self, ring, conn):
+        self.ring = ring
+        self.conn = conn
+
+    def send(self, obj):
+        self.send_bytes(encode(obj))
+
+    def send_bytes(self, data):
+        write_pos = self.ring.write(data)
+        if write_pos is None:
+            write_pos = struct.unpack_from('Q', self.ring.buf, 0)[0]
+            self.conn.send_bytes(struct.pack('Q', write_pos) + data)
+        else:
+            self.conn.send_bytes(struct.pack('Q', write_pos))
+
+    def close(self):
+        self.conn.close()
+
+
+class ShmReceiver:
+    # The receiving end, it can be waited on with multiprocessing.connection.wait like a pipe.
+    # Each recv returns the records announced so far in one list, so a reader that was down
+    # for a while, or that missed a wakeup, catches up in one go.
+    def __init__(self, ring, conn):
+        self.ring = ring
+        self.conn = conn
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def poll(self, timeout=0.0):
+        return self.conn.poll(timeout)
+
+    def recv(self, decoder=None):
+        data = self.conn.recv_bytes()
+        limit = struct.unpack_from('Q', data, 0)[0]
+        batch = []
+        while True:
+            record = self.ring.read(limit)
+            if record is None:
+                break
+            view, read_pos = record
+            try:
+                batch.extend(decode(view, decoder))
+            finally:
+                view.release()
+            self.ring.commit(read_pos)
+        if len(data) > 8:
+            batch.extend(decode(memoryview(data)[8:], decoder))
+        return batch
+
+    def close(self):
+        self.conn.close()
+
+
+def shm_pipe(size):
+    # Same as multiprocessing.Pipe(duplex=False), the ends are returned with the ring they share.
+    ring = ShmRing(size)
+    recv_end, send_end = multiprocessing.Pipe(duplex=False)
+    return ShmReceiver(ring, recv_end), ShmSender(ring, send_end), ring
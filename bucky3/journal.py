@@ -98,9 +98,13 @@ class SystemdJournal(module.MetricsSrcProcess, tracing.Tracer):
                 try:
                     if p.poll(3000):
                         if j.process() == journal.APPEND:
-                            recv_timestamp = time.time()
+                            recv_timestamp, size = time.time(), 0
                             for event in j:
                                 self.handle_event(recv_timestamp, event)
+                                message = event.get('MESSAGE')
+                                if isinstance(message, (str, bytes)):
+                                    size += len(message)
+                            self.eager_flush_check(size)
                 except InterruptedError:
                     pass
 
@@ -2,7 +2,6 @@
 
 import json
 import time
-import socket
 import zlib
 import gzip
 import bucky3.module as module
@@ -12,42 +11,61 @@ class JsonDServer(module.MetricsSrcProcess, module.UDPConnector):
     def __init__(self, *args):
         super().__init__(*args)
         self.sock = None
+        self.unix_sock = None
         self.json_decoder = json.JSONDecoder()
+        self.datagrams_received = 0
+        self.datagrams_dropped = 0
+        self.datagrams_truncated = 0
+        self.bytes_received = 0
+        self.recv_stats_last = None
+        self.parse_errors = 0
 
     def init_cfg(self):
         super().init_cfg()
         self.timestamp_window = self.cfg.get('timestamp_window', 600)
 
     def read_loop(self):
-        sock = self.open_socket(bind=True)
+        self.init_recv()
         while True:
             try:
-                data, addr = sock.recvfrom(65535)
-                try:
-                    data = zlib.decompress(data)
-                except zlib.error:
-                    try:
-                        data = gzip.decompress(data)
-                    except OSError:
-                        pass
-                self.handle_packet(data, addr)
-            except (InterruptedError, socket.timeout):
+                for data in self.recv_batch():
+                    self.handle_datagram(data)
+            except InterruptedError:
                 pass
 
+    def handle_datagram(self, data):
+        try:
+            data = zlib.decompress(data)
+        except zlib.error:
+            try:
+                data = gzip.decompress(data)
+            except OSError:
+                pass
+        self.handle_packet(data)
+
     def loop(self):
         self.start_thread('UdpReadThread', self.read_loop)
         super().loop()
 
+    def produce_self_report(self):
+        self_report = super().produce_self_report()
+        self_report.update(self.recv_stats())
+        self_report['parse_errors'] = self.parse_errors
+        return self_report
+
     def handle_packet(self, data, addr=None):
+        size = len(data)
         try:
             recv_timestamp, data = round(time.time(), 3), data.decode('utf-8')
         except UnicodeDecodeError:
+            self.parse_errors += 1
             return
         # http://ndjson.org/
         for line in data.splitlines():
             line = line.strip()
             if line:
                 self.handle_line(recv_timestamp, line)
+        self.eager_flush_check(size)
 
     def handle_line(self, recv_timestamp, line):
         try:
@@ -55,13 +73,16 @@ class JsonDServer(module.MetricsSrcProcess, module.UDPConnector):
             obj, end = self.json_decoder.raw_decode(line)
             if end == len(line) and isinstance(obj, dict) and obj:
                 self.handle_obj(recv_timestamp, obj)
+            else:
+                self.parse_errors += 1
         except ValueError:
-            return
+            self.parse_errors += 1
 
     def handle_obj(self, recv_timestamp, obj):
         # Only flat objects with basic types
         for k, v in obj.items():
             if not isinstance(v, (int, float, bool, str)) and v is not None:
+                self.parse_errors += 1
                 return
         # Parsing ISO/RFC would be really nice, but in Python is not going to be simple
         # and fast. So let's accept only a sensible number of secs / millis from epoch.
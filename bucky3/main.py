@@ -24,6 +24,7 @@ import argparse
 import importlib
 import multiprocessing
 import bucky3.cfg as cfg
+import bucky3.ipc as ipc
 import bucky3.module as module
 
 
@@ -47,6 +48,7 @@ class Manager(module.Logger):
         self.log = None
         self.src_group = {}
         self.dst_group = {}
+        self.shm_rings = []
 
     def import_module(self, module_package, module_class):
         m = importlib.import_module(module_package)
@@ -81,24 +83,38 @@ class Manager(module.Logger):
                     module_config[k] = v
 
         for module_name, module_class, module_config in src_modules:
-            destination_modules = module_config.get('destination_modules')
-            if destination_modules:
-                tmp = []
-                for m in destination_modules:
-                    if isinstance(m, str):
-                        found_destinations = tuple(filter(lambda i: i[0] == m, dst_modules))
-                    else:
-                        found_destinations = tuple(filter(lambda i: id(i[2]) == id(m), dst_modules))
-                    if found_destinations:
-                        tmp.append(found_destinations[0])
-                    else:
-                        raise ValueError("No configured destination found for " + module_name)
-                module_config['destination_modules'] = tmp
-            else:
-                module_config['destination_modules'] = dst_modules
+            module_config['destination_modules'] = self.find_destinations(
+                module_name, module_config.get('destination_modules'), dst_modules
+            )
+            rollups = []
+            for rollup in module_config.get('rollups', ()):
+                # Rollups route to the destinations of the module unless they have their own.
+                destination_modules = rollup.get('destination_modules')
+                if destination_modules:
+                    destination_modules = self.find_destinations(module_name, destination_modules, dst_modules)
+                else:
+                    destination_modules = module_config['destination_modules']
+                rollups.append(dict(rollup, destination_modules=destination_modules))
+            if rollups:
+                module_config['rollups'] = rollups
 
         return new_config, src_modules, dst_modules
 
+    def find_destinations(self, module_name, destination_modules, dst_modules):
+        if not destination_modules:
+            return dst_modules
+        tmp = []
+        for m in destination_modules:
+            if isinstance(m, str):
+                found_destinations = tuple(filter(lambda i: i[0] == m, dst_modules))
+            else:
+                found_destinations = tuple(filter(lambda i: id(i[2]) == id(m), dst_modules))
+            if found_destinations:
+                tmp.append(found_destinations[0])
+            else:
+                raise ValueError("No configured destination found for " + module_name)
+        return tmp
+
     def terminate_process(self, proc):
         err = 0
         if proc.exitcode is None:
@@ -124,6 +140,8 @@ class Manager(module.Logger):
     def terminate_and_exit(self, err=0):
         err += self.terminate_group(self.src_group)
         err += self.terminate_group(self.dst_group)
+        for ring in self.shm_rings:
+            ring.unlink()
         sys.exit(err != 0)
 
     def start_module(self, module_name, module_class, module_config, timestamps, args, message="Starting %s"):
@@ -172,15 +190,31 @@ class Manager(module.Logger):
         # which means the receiving end tries to unpickle the corrupted stream. So we use N x M pipes.
         recv_ends = {}
         for module_name, module_class, module_config in src_modules:
-            send_ends = []
-            for dst_module in module_config['destination_modules']:
-                recv_end, send_end = multiprocessing.Pipe(duplex=False)
-                send_ends.append(send_end)
-                recv_ends.setdefault(dst_module[0], []).append(recv_end)
-            self.src_group[(module_name, module_class)] = module_config, [], None, (send_ends,)
+            args = (self.create_pipes(module_config, module_config['destination_modules'], recv_ends),)
+            if module_config.get('rollups'):
+                args += ([
+                    self.create_pipes(module_config, r['destination_modules'], recv_ends) for r in module_config['rollups']
+                ],)
+            self.src_group[(module_name, module_class)] = module_config, [], None, args
         for module_name, module_class, module_config in dst_modules:
             self.dst_group[(module_name, module_class)] = module_config, [], None, (recv_ends[module_name],)
 
+    def create_pipes(self, module_config, destination_modules, recv_ends):
+        ipc_transport = module_config.get('ipc_transport', 'pipe')
+        if ipc_transport == 'shm' and ipc.shared_memory is None:
+            self.log.warning("Shared memory not available, using pipes")
+            ipc_transport = 'pipe'
+        send_ends = []
+        for dst_module in destination_modules:
+            if ipc_transport == 'shm':
+                recv_end, send_end, ring = ipc.shm_pipe(module_config.get('ipc_buffer_size', 8 * 1024 * 1024))
+                self.shm_rings.append(ring)
+            else:
+                recv_end, send_end = multiprocessing.Pipe(duplex=False)
+            send_ends.append(send_end)
+            recv_ends.setdefault(dst_module[0], []).append(recv_end)
+        return send_ends
+
     def termination_handler(self, signal_number, stack_frame):
         self.terminate_and_exit(0)
 
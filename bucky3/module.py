@@ -1,16 +1,30 @@
 
 
 import io
+import os
 import sys
+import math
+import stat
 import time
 import socket
+import struct
 import signal
+import heapq
 import random
 import logging
 import resource
+import selectors
+import collections
 import threading
 import multiprocessing
 import multiprocessing.connection
+import bucky3.ipc as ipc
+import bucky3.spill as spill
+
+
+# Linux specific, not exported by the socket module. With it enabled, each received datagram
+# carries the running count of datagrams the kernel dropped on the socket (i.e. buffer full).
+SO_RXQ_OVFL = getattr(socket, 'SO_RXQ_OVFL', 40 if sys.platform.startswith('linux') else None)
 
 
 def cached_with_timeout(timeout, allow_none=False):
@@ -106,11 +120,223 @@ class UDPConnector(Connector, HostResolver):
                 self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
                 if hasattr(socket, 'SO_REUSEPORT'):
                     self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                recv_buffer_size = self.cfg.get('recv_buffer_size')
+                if recv_buffer_size:
+                    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, recv_buffer_size)
+                if SO_RXQ_OVFL:
+                    try:
+                        self.sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+                    except OSError:
+                        self.log.warning('Could not enable drop accounting on UDP socket')
                 ip, port = self.resolve_local_host()
                 self.sock.bind((ip, port))
                 self.log.info("Bound UDP socket %s:%d", ip, port)
         return self.sock
 
+    def open_unix_socket(self):
+        # Same host clients can skip the IP stack, and they get EAGAIN / block when the socket
+        # is full, rather than their datagrams being silently dropped.
+        unix_dgram_path = self.cfg.get('unix_dgram_path')
+        if unix_dgram_path and self.unix_sock is None:
+            self.unix_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            recv_buffer_size = self.cfg.get('recv_buffer_size')
+            if recv_buffer_size:
+                self.unix_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, recv_buffer_size)
+            self.bind_unix_socket(self.unix_sock, unix_dgram_path)
+            self.log.info("Bound Unix socket %s", unix_dgram_path)
+        return self.unix_sock
+
+    def close_unix_socket(self):
+        if self.unix_sock:
+            self.unix_sock.close()
+            self.log.debug('Closed Unix socket')
+        self.unix_sock = None
+
+    def init_recv(self):
+        # Both sockets are drained without blocking, waiting for data is left to the selector.
+        self.recv_selector = selectors.DefaultSelector()
+        # With local_host set to None, only the Unix socket is used.
+        if self.cfg.get('local_host', '') is not None:
+            sock = self.open_socket(bind=True)
+            sock.setblocking(False)
+            self.recv_selector.register(sock, selectors.EVENT_READ)
+        unix_sock = self.open_unix_socket()
+        if unix_sock:
+            unix_sock.setblocking(False)
+            self.recv_selector.register(unix_sock, selectors.EVENT_READ)
+        if not self.recv_selector.get_map():
+            raise ValueError("Neither local_host nor unix_dgram_path configured")
+        self.recv_batch_size = max(self.cfg.get('recv_batch_size', 64), 1)
+        self.recv_buffer = memoryview(bytearray(65535))
+        self.recv_ancillary_size = socket.CMSG_SPACE(4) if SO_RXQ_OVFL else 0
+
+    def recv_batch(self):
+        # Wait for the first datagram, then take whatever else is already queued up, up to recv_batch_size.
+        # This saves us the wakeups and per datagram processing when traffic is bursty.
+        batch = []
+        for key, events in self.recv_selector.select(self.socket_timeout):
+            sock = key.fileobj
+            while len(batch) < self.recv_batch_size:
+                try:
+                    size, ancdata, flags, addr = sock.recvmsg_into((self.recv_buffer,), self.recv_ancillary_size)
+                except BlockingIOError:
+                    break
+                self.bytes_received += size
+                if flags & socket.MSG_TRUNC:
+                    # Unix datagrams can be bigger than the buffer, what's left of them may still parse.
+                    self.datagrams_truncated += 1
+                    continue
+                batch.append(self.recv_buffer[:size].tobytes())
+                for level, kind, data in ancdata:
+                    if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL and len(data) >= 4:
+                        self.datagrams_dropped = struct.unpack('I', data[:4])[0]
+        self.datagrams_received += len(batch)
+        return batch
+
+    def recv_queue_stats(self):
+        # Linux only, finds the UDP socket by its inode in /proc/net/udp and returns the bytes waiting
+        # in its receive queue and its drop count. Unlike SO_RXQ_OVFL, the latter doesn't need
+        # another datagram to make it through to be up to date.
+        if self.sock is None:
+            return None
+        inode = str(os.fstat(self.sock.fileno()).st_ino)
+        for path in ('/proc/net/udp', '/proc/net/udp6'):
+            try:
+                with open(path) as f:
+                    next(f, None)
+                    for line in f:
+                        fields = line.split()
+                        if len(fields) > 12 and fields[9] == inode:
+                            return int(fields[4].partition(':')[2], 16), int(fields[12])
+            except (OSError, ValueError):
+                continue
+        return None
+
+    def recv_stats(self):
+        recv_stats = {
+            'datagrams_received': self.datagrams_received,
+            'bytes_received': self.bytes_received,
+            'datagrams_truncated': self.datagrams_truncated,
+        }
+        queue_stats = self.recv_queue_stats()
+        if queue_stats:
+            recv_stats['recv_queue_bytes'], datagrams_dropped = queue_stats
+            self.datagrams_dropped = max(self.datagrams_dropped, datagrams_dropped)
+        recv_stats['datagrams_dropped'] = self.datagrams_dropped
+        # The rate is since the previous call, i.e. the previous self report or flush of a worker.
+        now = time.perf_counter()
+        if self.recv_stats_last:
+            last_timestamp, last_bytes_received = self.recv_stats_last
+            if now > last_timestamp:
+                recv_stats['bytes_received_rate'] = round((self.bytes_received - last_bytes_received) / (now - last_timestamp), 3)
+        self.recv_stats_last = now, self.bytes_received
+        return recv_stats
+
+
+class StreamListener(HostResolver):
+    # Newline framed input over TCP and Unix stream sockets. All listeners and connections are
+    # served by a single selector, complete lines are passed on to handle_stream_lines in chunks.
+    def init_stream_listeners(self):
+        self.stream_selector = selectors.DefaultSelector()
+        self.stream_connections = {}
+        self.stream_connections_accepted = 0
+        self.stream_max_line_length = self.cfg.get('stream_max_line_length', 65535)
+        tcp_local_host = self.cfg.get('tcp_local_host')
+        if tcp_local_host:
+            resolved_hosts = tuple(self.resolve_host(tcp_local_host, 0))
+            if not resolved_hosts:
+                raise ValueError("Could not resolve local host " + str(tcp_local_host))
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(resolved_hosts[0])
+            self.listen_stream(sock)
+            self.log.info("Listening on TCP socket %s:%d", *sock.getsockname())
+        unix_stream_path = self.cfg.get('unix_stream_path')
+        if unix_stream_path:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.bind_unix_socket(sock, unix_stream_path)
+            self.listen_stream(sock)
+            self.log.info("Listening on Unix socket %s", unix_stream_path)
+        return bool(self.stream_selector.get_map())
+
+    def listen_stream(self, sock):
+        sock.listen(128)
+        sock.setblocking(False)
+        self.stream_selector.register(sock, selectors.EVENT_READ)
+
+    def close_stream_listeners(self):
+        for key in list(self.stream_selector.get_map().values()):
+            self.stream_selector.unregister(key.fileobj)
+            key.fileobj.close()
+        self.stream_connections = {}
+
+    def stream_loop(self):
+        while True:
+            self.stream_poll(self.socket_timeout)
+
+    def stream_poll(self, timeout):
+        for key, events in self.stream_selector.select(timeout):
+            if key.data is None:
+                self.accept_stream(key.fileobj)
+            else:
+                self.recv_stream(key.fileobj, key.data)
+
+    def accept_stream(self, sock):
+        try:
+            conn, addr = sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        conn.setblocking(False)
+        self.stream_connections_accepted += 1
+        if isinstance(addr, tuple):
+            name = '%s:%d' % addr[:2]
+        else:
+            name = 'unix:%d' % self.stream_connections_accepted
+        state = {'name': name, 'remainder': b'', 'bytes_received': 0, 'lines_received': 0}
+        self.stream_connections[conn] = state
+        self.stream_selector.register(conn, selectors.EVENT_READ, state)
+        self.log.debug("Accepted stream connection %s", name)
+
+    def close_stream(self, conn):
+        self.stream_selector.unregister(conn)
+        state = self.stream_connections.pop(conn)
+        conn.close()
+        self.log.debug("Closed stream connection %s", state['name'])
+
+    def recv_stream(self, conn, state):
+        try:
+            data = conn.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            # The last line doesn't have to be terminated
+            if state['remainder']:
+                state['lines_received'] += 1
+                self.handle_stream_lines(state['remainder'])
+            self.close_stream(conn)
+            return
+        state['bytes_received'] += len(data)
+        i = data.rfind(b"\n")
+        if i < 0:
+            state['remainder'] += data
+            if len(state['remainder']) > self.stream_max_line_length:
+                self.log.warning("Line too long on stream connection %s, closing it", state['name'])
+                state['remainder'] = b''
+                self.close_stream(conn)
+            return
+        lines, state['remainder'] = state['remainder'] + data[:i], data[i + 1:]
+        state['lines_received'] += lines.count(b"\n") + 1
+        self.handle_stream_lines(lines)
+
+    def stream_self_report(self):
+        for state in list(self.stream_connections.values()):
+            yield {'connection': state['name']}, {
+                'bytes_received': state['bytes_received'],
+                'lines_received': state['lines_received'],
+            }
+
 
 class TCPConnector(Connector, HostResolver):
     # To provide load balancing, when pushing via TCP, we reopen the connection
@@ -146,6 +372,165 @@ class TCPConnector(Connector, HostResolver):
         return self.sock
 
 
+class DestinationQueue:
+    # Decouples a destination from the flush and from the other destinations. Encoded chunks are
+    # queued up to limit bytes and sent by a dedicated thread. When the destination falls behind,
+    # the policy decides what gives: drop_oldest, drop_newest or spill (to spill_queue on disk).
+    def __init__(self, name, pipe, limit, policy, spill_queue=None):
+        self.name = name
+        self.pipe = pipe
+        self.limit = limit
+        self.policy = policy
+        self.spill_queue = spill_queue
+        self.cond = threading.Condition()
+        self.queue = collections.deque()
+        self.queue_size = 0
+        # What is left of the dropped oldest chunks, it goes out before anything in the queue.
+        self.definitions = collections.deque()
+        self.chunks_sent = 0
+        self.chunks_dropped = 0
+        self.chunks_spilled = 0
+
+    def put(self, data):
+        with self.cond:
+            if self.spill_queue is not None and (self.spill_queue.records or self.queue_size + len(data) > self.limit):
+                # Once spilling, all goes to disk until it's drained, to keep the order.
+                if self.spill_queue.append(data):
+                    self.chunks_spilled += 1
+                else:
+                    self.drop(data, self.spill_queue.append)
+            elif self.policy == 'drop_newest' and self.queue_size + len(data) > self.limit:
+                self.drop(data, self.append)
+            else:
+                self.append(data)
+                while self.queue_size > self.limit:
+                    timestamp, oldest = self.queue.popleft()
+                    self.queue_size -= len(oldest)
+                    self.drop(oldest, self.definitions.append)
+            self.cond.notify()
+
+    def append(self, data):
+        self.queue.append((time.time(), data))
+        self.queue_size += len(data)
+
+    def drop(self, data, keep):
+        self.chunks_dropped += 1
+        stripped = ipc.strip(data)
+        if stripped:
+            base, definitions = stripped
+            if base == 0:
+                # A new session, the definitions from before are of no use.
+                self.definitions.clear()
+            keep(definitions)
+
+    def send_loop(self):
+        while True:
+            with self.cond:
+                while not (self.definitions or self.queue or (self.spill_queue is not None and self.spill_queue.records)):
+                    self.cond.wait()
+                if self.definitions:
+                    data = self.definitions.popleft()
+                elif self.queue:
+                    timestamp, data = self.queue.popleft()
+                    self.queue_size -= len(data)
+                else:
+                    data = None
+            if data is None:
+                record = self.spill_queue.peek()
+                if record is None:
+                    continue
+                self.pipe.send_bytes(record[1])
+                self.spill_queue.pop()
+            else:
+                self.pipe.send_bytes(data)
+            self.chunks_sent += 1
+
+    def stats(self):
+        with self.cond:
+            if self.queue:
+                oldest = self.queue[0][0]
+            elif self.spill_queue is not None and self.spill_queue.records:
+                record = self.spill_queue.peek()
+                oldest = record[0] if record else None
+            else:
+                oldest = None
+            stats = {
+                'queue_size': self.queue_size,
+                'queue_chunks': len(self.queue),
+                'lag': round(max(time.time() - oldest, 0), 3) if oldest else 0,
+                'chunks_sent': self.chunks_sent,
+                'chunks_dropped': self.chunks_dropped,
+            }
+            if self.spill_queue is not None:
+                stats['chunks_spilled'] = self.chunks_spilled
+                stats['spill_size'] = self.spill_queue.size
+                stats['spill_chunks'] = self.spill_queue.records
+                stats['spill_dropped'] = self.spill_queue.records_dropped
+            return stats
+
+
+class Scheduler:
+    """
+    Runs periodic jobs off a heap ordered by the time they are due, so the caller only needs
+    to wake up when the first one is. A job runs every interval seconds, or after as many
+    seconds as its callback returns, if it does. Due times are kept on the job's own schedule,
+    only a job that overran its interval starts over from when it finished. Jobs with align
+    run at offset seconds past wall clock multiples of align instead. The max delay of a job
+    past its due time (i.e. a late wakeup or a job running long) is kept in jitter.
+    """
+
+    def __init__(self):
+        self.jobs = []
+        self.job_count = 0
+        self.jitter = 0
+
+    def add_job(self, name, callback, interval, delay=0, align=None):
+        # With align, delay is the offset past the multiples of align
+        self.job_count += 1
+        due = time.monotonic() + (self.aligned_delay(align, delay) if align else delay)
+        heapq.heappush(self.jobs, (due, self.job_count, name, callback, interval, align, delay))
+
+    def aligned_delay(self, align, offset, interval=None):
+        # Wall clock and monotonic time drift apart, so every run is aligned afresh.
+        now = time.time() - offset
+        if interval is None:
+            target = math.ceil(now / align) * align
+        else:
+            # Rounded, the job may have run a bit before or after the multiple it was due at
+            target = round((now + interval) / align) * align
+        return max(target - now, 0)
+
+    def run_pending(self):
+        now = time.monotonic()
+        while self.jobs and self.jobs[0][0] <= now:
+            due, job_id, name, callback, interval, align, offset = heapq.heappop(self.jobs)
+            self.jitter = max(self.jitter, now - due)
+            next_interval = None
+            try:
+                next_interval = callback()
+            finally:
+                # Even if the callback raised, the job must stay scheduled.
+                if next_interval is None:
+                    next_interval = interval
+                now = time.monotonic()
+                if align:
+                    due = now + self.aligned_delay(align, offset, next_interval)
+                else:
+                    due += next_interval
+                    if due <= now:
+                        due = now + next_interval
+                heapq.heappush(self.jobs, (due, job_id, name, callback, interval, align, offset))
+
+    def timeout(self):
+        if not self.jobs:
+            return None
+        return max(self.jobs[0][0] - time.monotonic(), 0)
+
+    def take_jitter(self):
+        jitter, self.jitter = self.jitter, 0
+        return jitter
+
+
 class MetricsProcess(multiprocessing.Process, Logger):
     def __init__(self, module_name, module_config):
         super().__init__(name=module_name, daemon=True)
@@ -154,7 +539,11 @@ class MetricsProcess(multiprocessing.Process, Logger):
 
     def tick(self):
         self.log.debug("Flush")
-        if self.flush(round(time.time(), 3)):
+        system_timestamp = round(time.time(), 3)
+        if self.align_flush:
+            # The multiple of flush_interval the flush was scheduled for, give or take a few millis
+            system_timestamp = round(round(system_timestamp / self.tick_interval) * self.tick_interval, 3)
+        if self.flush(system_timestamp):
             self.flush_interval = self.tick_interval
         else:
             self.flush_interval = min(self.flush_interval + self.flush_interval, self.max_flush_interval)
@@ -173,13 +562,18 @@ class MetricsProcess(multiprocessing.Process, Logger):
         self.chunk_size = max(self.cfg.get('chunk_size', 300), 1)
         self.tick_interval = self.flush_interval = max(self.cfg['flush_interval'], 1)
         self.max_flush_interval = max(self.flush_interval, self.cfg.get('max_flush_interval', 600))
-        self.next_tick = self.next_flush = 0
+        self.align_flush = self.cfg.get('align_flush', False)
+        self.flush_offset = 0
+        self.scheduler = Scheduler()
+        # Set when there is something for the main loop to look at before the next job is due
+        self.wakeup = threading.Event()
         self.metadata = self.cfg.get('metadata', {})
         self.metric_postprocessor = self.cfg.get('metric_postprocessor')
         self.add_timestamps = self.cfg.get('add_timestamps', False)
         self.self_report = self.cfg.get('self_report', False)
         self.init_timestamp = time.monotonic()
         self.threads = []
+        self.unix_socket_files = {}
 
     def run(self):
         def termination_handler(signal_number, stack_frame):
@@ -192,10 +586,13 @@ class MetricsProcess(multiprocessing.Process, Logger):
 
         self.init_cfg()
         self.log.info("Set up")
-        if self.randomize_startup and self.tick_interval > 3:
+        if self.randomize_startup and self.tick_interval > 3 and not self.align_flush:
             # If randomization is configured (it's default) do it asap
             time.sleep(random.randint(0, min(self.tick_interval - 1, 15)))
-        self.loop()
+        try:
+            self.loop()
+        finally:
+            self.remove_unix_socket_files()
 
     def ended_threads(self):
         ended = False
@@ -204,31 +601,30 @@ class MetricsProcess(multiprocessing.Process, Logger):
             ended = True
         return ended
 
+    def schedule_jobs(self):
+        # Modules can schedule their own housekeeping along these.
+        self.scheduler.add_job(
+            'flush', self.flush_job, self.tick_interval,
+            delay=self.flush_offset, align=self.tick_interval if self.align_flush else None
+        )
+        if self.self_report:
+            self.scheduler.add_job('self_report', self.take_self_report, max(self.tick_interval, 60))
+
+    def flush_job(self):
+        self.tick()
+        return self.flush_interval
+
     def loop(self):
-        self.next_tick = time.monotonic()
+        self.schedule_jobs()
         while True:
             try:
-                self.log.debug("Tick")
-                now = time.monotonic()
-                if now >= self.next_flush:
-                    self.tick()
-                    # Occasionally, at least on macOS, kernel wakes up the process a few millis earlier
-                    # then scheduled (most likely scheduling we do here is introducing some small slips),
-                    # which triggers the condition at the top of the function and we miss a legit tick.
-                    # The 0.03s is a harmless margin that seems to solve the problem.
-                    self.next_flush = now + self.flush_interval - 0.03
                 if self.ended_threads():
                     self.log.error("Aborting")
                     sys.exit(1)
-                if self.self_report:
-                    self.take_self_report()
-                now = time.monotonic()
-                while now + 0.3 >= self.next_tick:
-                    self.next_tick += self.tick_interval
-                sleep_duration = self.next_tick - now
-                if sleep_duration > 4:
-                    sleep_duration = 3
-                time.sleep(sleep_duration)
+                self.log.debug("Tick")
+                self.scheduler.run_pending()
+                self.wakeup.wait(self.scheduler.timeout())
+                self.wakeup.clear()
             except InterruptedError:
                 pass
 
@@ -240,9 +636,13 @@ class MetricsProcess(multiprocessing.Process, Logger):
             'memory': usage.ru_maxrss,
             'uptime': round(now - self.init_timestamp, 3),
             'flush_errors': self.flush_errors,
+            'schedule_jitter': round(self.scheduler.take_jitter(), 3),
         }
 
-    @cached_with_timeout(timeout=60, allow_none=True)
+    def produce_self_report_details(self):
+        # Modules can report more series along the main one, as (metadata, stats) pairs.
+        return ()
+
     def take_self_report(self):
         # Source modules will push their self reported metrics to their respective destination modules.
         # But destination modules only expose their metrics to what consumes their output.
@@ -252,6 +652,9 @@ class MetricsProcess(multiprocessing.Process, Logger):
             None,
             {'name': self.name},
         )
+        for metadata, stats in self.produce_self_report_details():
+            metadata.update(name=self.name)
+            self.process_self_report("bucky3", stats, None, metadata)
 
     def merge_dict(self, dst, src=None):
         if src is None:
@@ -261,10 +664,37 @@ class MetricsProcess(multiprocessing.Process, Logger):
         return dst
 
     def start_thread(self, name, target):
-        thread = threading.Thread(name=name, target=target, daemon=True)
+        def run_thread():
+            try:
+                target()
+            finally:
+                # The main loop checks on threads as soon as one ends
+                self.wakeup.set()
+
+        thread = threading.Thread(name=name, target=run_thread, daemon=True)
         thread.start()
         self.threads.append(thread)
 
+    def bind_unix_socket(self, sock, path):
+        # A socket file left behind by a previous run would make bind fail.
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+        sock.bind(path)
+        unix_socket_permissions = self.cfg.get('unix_socket_permissions')
+        if unix_socket_permissions is not None:
+            os.chmod(path, unix_socket_permissions)
+        self.unix_socket_files[path] = os.stat(path).st_ino
+
+    def remove_unix_socket_files(self):
+        # Only the files still ours, another instance may have taken the paths over in the meantime.
+        for path, inode in self.unix_socket_files.items():
+            try:
+                if os.stat(path).st_ino == inode:
+                    os.unlink(path)
+            except OSError:
+                pass
+        self.unix_socket_files = {}
+
 
 class MetricsSrcProcess(MetricsProcess):
     def __init__(self, module_name, module_config, dst_pipes):
@@ -276,6 +706,23 @@ class MetricsSrcProcess(MetricsProcess):
     def init_cfg(self):
         super().init_cfg()
         self.log.info('Destination modules: ' + ', '.join(m[0] for m in self.cfg['destination_modules']))
+        self.ipc_interning = self.cfg.get('ipc_interning', False)
+        self.encoders = {}
+        self.dst_queue_policy = self.cfg.get('dst_queue_policy')
+        if self.dst_queue_policy not in (None, 'drop_oldest', 'drop_newest', 'spill'):
+            self.log.warning("Unknown destination queue policy %s, using drop_oldest", self.dst_queue_policy)
+            self.dst_queue_policy = 'drop_oldest'
+        if self.dst_queue_policy == 'spill' and not self.cfg.get('spill_path'):
+            self.log.warning("No spill_path configured, using drop_oldest")
+            self.dst_queue_policy = 'drop_oldest'
+        self.dst_queue_limit = self.cfg.get('dst_queue_limit', 16 * 1024 * 1024)
+        self.dst_names = {pipe: m[0] for m, pipe in zip(self.cfg['destination_modules'], self.dst_pipes)}
+        self.dst_queues = {}
+        # Flushes can come from the ingest thread too, one at a time keeps chunks whole and in order.
+        self.flush_lock = threading.Lock()
+        self.eager_flush = self.cfg.get('eager_flush', False)
+        self.eager_flush_bytes = self.cfg.get('eager_flush_bytes')
+        self.buffer_bytes = 0
 
     def buffer_metric(self, bucket, stats, timestamp, metadata):
         if metadata:
@@ -308,32 +755,98 @@ class MetricsSrcProcess(MetricsProcess):
         self.buffer_metric(bucket, stats, timestamp, metadata)
 
     def flush(self, system_timestamp):
-        while self.buffer:
-            with self.buffer_lock:
-                chunk = self.buffer[0:self.chunk_size]
-                if not chunk:
-                    break
-                # TODO this doesn't look sound, if sending to dst pipes fails for a reason later on, we lose the chunk
-                del self.buffer[0:self.chunk_size]
-            self.log.debug("Flushing %d entries from buffer", len(chunk))
-            for dst in self.dst_pipes:
-                dst.send(chunk)
+        self.flush_buffer(self.dst_pipes)
         return True
 
+    def flush_buffer(self, dst_pipes, partial=True):
+        with self.flush_lock:
+            with self.buffer_lock:
+                buffer_len, buffer_bytes = len(self.buffer), self.buffer_bytes
+            sent = 0
+            while self.buffer:
+                with self.buffer_lock:
+                    if not partial and len(self.buffer) < self.chunk_size:
+                        break
+                    chunk = self.buffer[0:self.chunk_size]
+                    if not chunk:
+                        break
+                    # TODO this doesn't look sound, if sending to dst pipes fails for a reason later on, we lose the chunk
+                    del self.buffer[0:self.chunk_size]
+                self.send_chunk(dst_pipes, chunk)
+                sent += len(chunk)
+            with self.buffer_lock:
+                # Entries don't carry their input size, what was sent is accounted for pro rata.
+                if not self.buffer:
+                    self.buffer_bytes = 0
+                elif buffer_len:
+                    self.buffer_bytes -= buffer_bytes * min(sent, buffer_len) // buffer_len
+
+    def send_chunk(self, dst_pipes, chunk):
+        self.log.debug("Flushing %d entries from buffer", len(chunk))
+        # Encoded once, no matter how many destinations it goes to
+        if self.ipc_interning:
+            encoder = self.encoders.get(tuple(dst_pipes))
+            if encoder is None:
+                encoder = self.encoders[tuple(dst_pipes)] = ipc.Encoder()
+            data = encoder.encode(chunk)
+        else:
+            data = ipc.encode(chunk)
+        if self.dst_queue_policy:
+            for dst in dst_pipes:
+                self.get_dst_queue(dst).put(data)
+        else:
+            for dst in dst_pipes:
+                dst.send_bytes(data)
+
+    def eager_flush_check(self, size=0):
+        # Called by the ingest threads of modules buffering metrics as they come in, with the size
+        # of the input just buffered. Sends full chunks on right away, and everything once there
+        # is eager_flush_bytes of input behind the buffer, rather than waiting for the next tick.
+        if not self.eager_flush:
+            return
+        with self.buffer_lock:
+            self.buffer_bytes += size
+        if len(self.buffer) >= self.chunk_size:
+            self.flush_buffer(self.dst_pipes, partial=False)
+        elif self.eager_flush_bytes and self.buffer_bytes >= self.eager_flush_bytes:
+            self.flush_buffer(self.dst_pipes)
+
+    def get_dst_queue(self, dst):
+        dst_queue = self.dst_queues.get(dst)
+        if dst_queue is None:
+            name = self.dst_names.get(dst, str(len(self.dst_queues)))
+            spill_queue = None
+            if self.dst_queue_policy == 'spill':
+                spill_queue = spill.SpillQueue(
+                    os.path.join(self.cfg['spill_path'], self.name, name),
+                    self.cfg.get('spill_limit', 1024 * 1024 * 1024)
+                )
+            dst_queue = DestinationQueue(name, dst, self.dst_queue_limit, self.dst_queue_policy, spill_queue)
+            self.dst_queues[dst] = dst_queue
+            self.start_thread('DstSendThread', dst_queue.send_loop)
+        return dst_queue
+
+    def produce_self_report_details(self):
+        for dst_queue in list(self.dst_queues.values()):
+            yield {'destination': dst_queue.name}, dst_queue.stats()
+
 
 class MetricsDstProcess(MetricsProcess):
     def __init__(self, module_name, module_config, src_pipes):
         super().__init__(module_name, module_config)
         self.src_pipes = src_pipes
         self.metrics_received = 0
+        self.decoders = {}
 
     def read_loop(self):
+        # Metadata dicts coming from interning sources are shared, process_values must not alter them.
+        self.decoders = {pipe: ipc.Decoder() for pipe in self.src_pipes}
         err = 0
         while True:
             tmp = False
             for pipe in multiprocessing.connection.wait(self.src_pipes):
                 try:
-                    self.process_batch(round(time.time(), 3), pipe.recv())
+                    self.process_batch(round(time.time(), 3), ipc.recv(pipe, self.decoders[pipe]))
                 except InterruptedError:
                     pass
                 except EOFError:
@@ -363,6 +876,13 @@ class MetricsDstProcess(MetricsProcess):
         self.process_values(round(time.time(), 3), bucket, stats, timestamp, self.merge_dict(metadata))
         self.metrics_received += 1
 
+    def produce_self_report(self):
+        self_report = super().produce_self_report()
+        metrics_undecoded = sum(decoder.dropped for decoder in self.decoders.values())
+        if metrics_undecoded:
+            self_report['metrics_undecoded'] = metrics_undecoded
+        return self_report
+
 
 class MetricsPushProcess(MetricsDstProcess, Connector):
     def __init__(self, *args, default_port=None):
@@ -372,28 +892,111 @@ class MetricsPushProcess(MetricsDstProcess, Connector):
         self.metrics_sent = 0
         self.metrics_rejected = 0
         self.metrics_dropped = 0
+        self.metrics_spilled = 0
         self.connection_errors = 0
+        self.spill_queue = None
 
     def init_cfg(self):
         super().init_cfg()
+        # Appended to by the reading thread (and self reports) under buffer_lock, taken from on the
+        # left by the flushing thread only, without the lock. Deque does either atomically, so the
+        # flush never holds up the producers.
+        self.buffer = collections.deque()
+        self.buffer_bytes_in = self.buffer_bytes_out = 0
+        self.buffer_size_limit = self.cfg.get('buffer_size_limit')
         self.push_count_limit = self.cfg.get('push_count_limit', self.buffer_limit)
         self.push_time_limit = self.cfg.get('push_time_limit', max(self.tick_interval / 3, 0.1))
+        self.max_push_latency = self.cfg.get('max_push_latency')
+        if self.max_push_latency is not None:
+            self.max_push_latency = max(self.max_push_latency, 0.001)
+        self.push_event = threading.Event()
+        # Hosts flushing their source modules at the same time (see align_flush) would otherwise
+        # all push at the same time, too.
+        self.flush_offset = random.uniform(0, self.cfg.get('push_jitter', 0))
+        buffer_policy = self.cfg.get('buffer_policy', 'trim')
+        if buffer_policy == 'spill' and not self.cfg.get('spill_path'):
+            self.log.warning("No spill_path configured, buffer overflow will be dropped")
+        elif buffer_policy == 'spill':
+            self.spill_queue = spill.SpillQueue(
+                os.path.join(self.cfg['spill_path'], self.name),
+                self.cfg.get('spill_limit', 1024 * 1024 * 1024)
+            )
+            self.spill_replay_rate = max(self.cfg.get('spill_replay_rate', self.buffer_limit), 1)
+            self.spill_replay_allowance = self.spill_replay_rate * self.tick_interval
+            self.spill_replay_timestamp = time.monotonic()
+        elif buffer_policy != 'trim':
+            self.log.warning("Unknown buffer policy %s, using trim", buffer_policy)
+
+    def loop(self):
+        if self.max_push_latency is not None:
+            self.start_thread('PushThread', self.push_loop)
+        super().loop()
 
     def tick(self):
+        # With max_push_latency, the push thread takes care of it
+        if self.max_push_latency is None:
+            self.push()
+
+    def push(self):
         super().tick()
         self.trim_buffer()
 
+    def push_loop(self):
+        # Pushes out chunks as soon as they fill up and whatever there is at least every max_push_latency.
+        while True:
+            self.push_event.wait(self.max_push_latency)
+            self.push_event.clear()
+            self.push()
+            if self.flush_interval > self.tick_interval:
+                # Backing off after a failed flush
+                time.sleep(self.flush_interval)
+            elif len(self.buffer) >= self.chunk_size:
+                # Left over by push_time_limit or push_count_limit
+                self.push_event.set()
+
+    def buffer_size(self):
+        return self.buffer_bytes_in - self.buffer_bytes_out
+
+    def take_buffer(self, count):
+        popleft = self.buffer.popleft
+        chunk = [popleft() for i in range(min(count, len(self.buffer)))]
+        self.buffer_bytes_out += sum(map(len, chunk))
+        return chunk
+
+    def return_buffer(self, chunk):
+        self.buffer.extendleft(reversed(chunk))
+        self.buffer_bytes_out -= sum(map(len, chunk))
+
     def trim_buffer(self):
-        with self.buffer_lock:
-            buffer_len = len(self.buffer)
-            if buffer_len > self.buffer_limit:
-                self.buffer = self.buffer[-int(self.buffer_limit / 2):]
-                self.log.warning("Buffer trimmed from %d to %d entries", buffer_len, len(self.buffer))
-                self.metrics_dropped += (buffer_len - len(self.buffer))
+        buffer_len = len(self.buffer)
+        over_size = self.buffer_size_limit and self.buffer_size() > self.buffer_size_limit
+        if buffer_len <= self.buffer_limit and not over_size:
+            return
+        overflow = []
+        if buffer_len > self.buffer_limit:
+            overflow = self.take_buffer(buffer_len - int(self.buffer_limit / 2))
+        if over_size:
+            while self.buffer and self.buffer_size() > self.buffer_size_limit / 2:
+                overflow.extend(self.take_buffer(1))
+        if self.spill_queue is None:
+            self.log.warning("Buffer trimmed from %d to %d entries", buffer_len, len(self.buffer))
+            self.metrics_dropped += len(overflow)
+            return
+        # The oldest entries go to disk, in chunks, to be replayed once pushing works again.
+        for i in range(0, len(overflow), self.chunk_size):
+            chunk = overflow[i:i + self.chunk_size]
+            if self.spill_queue.append(ipc.encode(chunk)):
+                self.metrics_spilled += len(chunk)
+            else:
+                self.metrics_dropped += len(chunk)
+        self.log.warning("Buffer trimmed from %d to %d entries, spilled to disk", buffer_len, len(self.buffer))
 
     def buffer_output(self, data):
         with self.buffer_lock:
             self.buffer.append(data)
+            self.buffer_bytes_in += len(data)
+        if len(self.buffer) >= self.chunk_size and not self.push_event.is_set():
+            self.push_event.set()
 
     def produce_self_report(self):
         self_report = super().produce_self_report()
@@ -402,10 +1005,41 @@ class MetricsPushProcess(MetricsDstProcess, Connector):
         self_report['metrics_rejected'] = self.metrics_rejected
         self_report['connection_errors'] = self.connection_errors
         self_report['metrics_buffered'] = len(self.buffer)
+        self_report['buffer_size'] = self.buffer_size()
+        if self.spill_queue is not None:
+            self_report['metrics_spilled'] = self.metrics_spilled
+            self_report['spill_size'] = self.spill_queue.size
+            self_report['spill_chunks'] = self.spill_queue.records
+            self_report['spill_dropped'] = self.spill_queue.records_dropped
         return self_report
 
+    def replay_spill(self, push_start):
+        # Spilled entries go out once the buffer is pushed and no faster than spill_replay_rate,
+        # so that the backlog doesn't swamp the destination once it's back up.
+        now = time.monotonic()
+        self.spill_replay_allowance = min(
+            self.spill_replay_allowance + (now - self.spill_replay_timestamp) * self.spill_replay_rate,
+            self.spill_replay_rate * self.tick_interval
+        )
+        self.spill_replay_timestamp = now
+        replayed = 0
+        while self.spill_replay_allowance > 0:
+            if time.monotonic() - push_start >= self.push_time_limit:
+                break
+            record = self.spill_queue.peek()
+            if record is None:
+                break
+            chunk = ipc.decode(record[1])
+            rejected_chunk = self.push_chunk(chunk)
+            self.spill_queue.pop()
+            self.metrics_sent += len(chunk) - len(rejected_chunk)
+            self.metrics_rejected += len(rejected_chunk)
+            self.spill_replay_allowance -= len(chunk)
+            replayed += len(chunk)
+        return replayed
+
     def flush(self, system_timestamp):
-        if not self.buffer:
+        if not self.buffer and not (self.spill_queue is not None and self.spill_queue.records):
             return True
         self.log.debug('%d entries in buffer to be pushed', len(self.buffer))
         push_start, push_counter, rejected_entries = time.monotonic(), 0, []
@@ -415,18 +1049,22 @@ class MetricsPushProcess(MetricsDstProcess, Connector):
                     break
                 if time.monotonic() - push_start >= self.push_time_limit:
                     break
-                chunk = self.buffer[:self.chunk_size]
+                chunk = self.take_buffer(self.chunk_size)
                 chunk_len = len(chunk)
-                # TODO we don't use the rejected metrics logic anywhere, remove it? Make it work?
-                rejected_chunk = self.push_chunk(chunk)
+                try:
+                    # TODO we don't use the rejected metrics logic anywhere, remove it? Make it work?
+                    rejected_chunk = self.push_chunk(chunk)
+                except Exception:
+                    self.return_buffer(chunk)
+                    raise
                 rejected_entries.extend(rejected_chunk)
                 self.metrics_sent += chunk_len - len(rejected_chunk)
                 self.metrics_rejected += len(rejected_chunk)
-                with self.buffer_lock:
-                    del self.buffer[:chunk_len]
                 push_counter += chunk_len  # Include all entries, even the failed ones
+            if self.spill_queue is not None and not self.buffer:
+                push_counter += self.replay_spill(push_start)
             # If we manage to push something then report success. Ok?
-            return push_counter > len(rejected_entries)
+            return not push_counter or push_counter > len(rejected_entries)
         except (ConnectionError, socket.timeout) as e:
             self.log.exception(e)
             self.close_socket()
@@ -434,7 +1072,6 @@ class MetricsPushProcess(MetricsDstProcess, Connector):
             return False
         finally:
             if rejected_entries:
-                with self.buffer_lock:
-                    self.buffer = rejected_entries + self.buffer
+                self.return_buffer(rejected_entries)
             if self.buffer:
                 self.log.warning('%d entries left over in buffer', len(self.buffer))
@@ -115,6 +115,7 @@ class PrometheusExporter(module.MetricsDstProcess, module.HostResolver):
         return self_report
 
     def process_values(self, recv_timestamp, bucket, values, metrics_timestamp, metadata):
+        metadata = dict(metadata)
         for k, v in values.items():
             if isinstance(v, bool):
                 v = int(v)
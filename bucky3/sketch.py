@@ -0,0 +1,189 @@
+
+
+import sys
+import math
+
+
+HASH_WIDTH = sys.hash_info.width
+HASH_MASK = (1 << HASH_WIDTH) - 1
+
+
+class DDSketch:
+    """
+    Quantile sketch with relative error guarantee, see https://arxiv.org/abs/1908.10693
+
+    Samples are counted in logarithmically sized bins, a value is estimated with a relative
+    error of at most relative_accuracy. The memory footprint depends on the range of values,
+    not on the number of samples, and is capped by max_bins (when exceeded, the bins of the
+    lowest values are collapsed). Unlike in the paper, bins also keep sums and sums of squares
+    of samples, which is what it takes to calculate mean and stdev per percentile the way statsd
+    does it.
+    Sketches with the same relative_accuracy can be merged.
+    """
+
+    __slots__ = ('relative_accuracy', 'gamma', 'log_gamma', 'max_bins',
+                 'positive', 'negative', 'zeros', 'count', 'min', 'max')
+
+    def __init__(self, relative_accuracy=0.01, max_bins=2048):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("Relative accuracy has to be within (0, 1)")
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_bins = max(max_bins, 1)
+        # Bins are index: [count, sum, sum of squares], negative values are binned by their magnitude.
+        self.positive = {}
+        self.negative = {}
+        self.zeros = 0
+        self.count = 0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def __len__(self):
+        return self.count
+
+    def __copy__(self):
+        return DDSketch(self.relative_accuracy, self.max_bins).merge(self)
+
+    def append(self, x):
+        if not math.isfinite(x):
+            raise ValueError("Only finite values can be added")
+        if x > 0:
+            bins, i = self.positive, math.ceil(math.log(x) / self.log_gamma)
+        elif x < 0:
+            bins, i = self.negative, math.ceil(math.log(-x) / self.log_gamma)
+        else:
+            bins = None
+        self.count += 1
+        if x < self.min:
+            self.min = x
+        if x > self.max:
+            self.max = x
+        if bins is None:
+            self.zeros += 1
+            return
+        b = bins.get(i)
+        if b is None:
+            bins[i] = [1, x, x * x]
+            if len(bins) > self.max_bins:
+                self.collapse(bins)
+        else:
+            b[0] += 1
+            b[1] += x
+            b[2] += x * x
+
+    def collapse(self, bins):
+        # Negative values are binned by their magnitude, so the lowest values are in the highest bins.
+        indexes = sorted(bins, reverse=bins is self.negative)
+        excess = len(indexes) - self.max_bins
+        b = bins[indexes[excess]]
+        for i in indexes[:excess]:
+            c, s, sq = bins.pop(i)
+            b[0] += c
+            b[1] += s
+            b[2] += sq
+
+    def merge(self, other):
+        if other.gamma != self.gamma:
+            raise ValueError("Only sketches with the same accuracy can be merged")
+        for bins, other_bins in ((self.positive, other.positive), (self.negative, other.negative)):
+            for i, (c, s, sq) in other_bins.items():
+                b = bins.get(i)
+                if b is None:
+                    bins[i] = [c, s, sq]
+                else:
+                    b[0] += c
+                    b[1] += s
+                    b[2] += sq
+            if len(bins) > self.max_bins:
+                self.collapse(bins)
+        self.zeros += other.zeros
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def value(self, i):
+        # The estimate that keeps the relative error within bounds for the whole bin
+        return 2 * self.gamma ** i / (self.gamma + 1)
+
+    def bins(self):
+        # Yields (count, sum, sum of squares, estimated value) in ascending order of values.
+        for i in sorted(self.negative, reverse=True):
+            c, s, sq = self.negative[i]
+            yield c, s, sq, -self.value(i)
+        if self.zeros:
+            yield self.zeros, 0.0, 0.0, 0.0
+        for i in sorted(self.positive):
+            c, s, sq = self.positive[i]
+            yield c, s, sq, self.value(i)
+
+    def prefixes(self, ranks):
+        # For each rank (ranks have to be ascending) yields (count, sum, sum of squares, upper)
+        # of the rank smallest samples. A bin split by a rank is assumed to hold alike samples.
+        ranks = iter(ranks)
+        rank = next(ranks, None)
+        vlen = vsum = vsum_squares = 0
+        for c, s, sq, v in self.bins():
+            while rank is not None and vlen + c >= rank:
+                n = max(rank - vlen, 0)
+                upper = self.max if rank >= self.count else min(max(v, self.min), self.max)
+                yield vlen + n, vsum + n * s / c, vsum_squares + n * sq / c, upper
+                rank = next(ranks, None)
+            if rank is None:
+                return
+            vlen += c
+            vsum += s
+            vsum_squares += sq
+
+
+class HyperLogLog:
+    """
+    Cardinality estimator, see http://algo.inria.fr/flajolet/Publications/FlFuGaMe07.pdf
+
+    Keeps 2 ** precision one byte registers, the standard error of estimates is about
+    1.04 / sqrt(2 ** precision), i.e. 1.6% for the precision of 12 (taking 4kB of memory).
+    Small cardinalities are estimated with linear counting. Values are hashed with the builtin
+    hash, which is randomized for strings per interpreter, but shared by forked processes,
+    so sketches can only be merged within the same process tree.
+    """
+
+    __slots__ = ('precision', 'registers')
+
+    def __init__(self, precision=12, values=()):
+        if not 4 <= precision <= 18:
+            raise ValueError("Precision has to be within [4, 18]")
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+        self.update(values)
+
+    def __len__(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        if estimate <= 2.5 * m:
+            zeros = self.registers.count(0)
+            if zeros:
+                estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def __copy__(self):
+        return HyperLogLog(self.precision).update(self)
+
+    def add(self, value):
+        bits = HASH_WIDTH - self.precision
+        h = hash(value) & HASH_MASK
+        i, w = h >> bits, h & ((1 << bits) - 1)
+        rank = bits - w.bit_length() + 1
+        if rank > self.registers[i]:
+            self.registers[i] = rank
+
+    def update(self, values):
+        if isinstance(values, HyperLogLog):
+            if values.precision != self.precision:
+                raise ValueError("Only sketches with the same precision can be merged")
+            self.registers = bytearray(map(max, self.registers, values.registers))
+        else:
+            for value in values:
+                self.add(value)
+        return self
@@ -0,0 +1,167 @@
+
+
+import os
+import time
+import struct
+import threading
+
+
+class SpillQueue:
+    """
+    FIFO queue of byte records on disk, kept in append-only segment files in a directory.
+
+    Records are appended to the last segment, which is rotated once it reaches segment_size,
+    and read from the first one, which is removed once consumed. The read position is kept
+    in the head file, so a restarted process picks up where the previous one left off (the
+    record being consumed at the time may get delivered twice). Once the segments would
+    exceed max_size bytes, the oldest one is dropped to make room. The queue can be shared
+    by a producer and a consumer thread.
+    """
+
+    RECORD = struct.Struct('<Id')  # Length and timestamp of the record
+    HEAD = struct.Struct('<QQ')    # Segment number and read offset
+
+    def __init__(self, path, max_size, segment_size=None):
+        self.path = path
+        self.max_size = max_size
+        self.segment_size = segment_size or max(min(max_size // 8, 64 * 1024 * 1024), 1)
+        self.lock = threading.Lock()
+        # Segments are [number, size, unread records]
+        self.segments = []
+        self.size = 0
+        self.records = 0
+        self.records_dropped = 0
+        self.writer = None
+        self.reader = None
+        self.read_offset = 0
+        self.peeked = None
+        os.makedirs(path, exist_ok=True)
+        self.head = os.open(os.path.join(path, 'head'), os.O_RDWR | os.O_CREAT, 0o600)
+        self.recover()
+
+    def segment_path(self, number):
+        return os.path.join(self.path, '%016d.seg' % number)
+
+    def recover(self):
+        numbers = sorted(int(f[:-4]) for f in os.listdir(self.path) if f.endswith('.seg') and f[:-4].isdigit())
+        head = os.pread(self.head, self.HEAD.size, 0)
+        head_number, head_offset = self.HEAD.unpack(head) if len(head) == self.HEAD.size else (0, 0)
+        for number in numbers:
+            if number < head_number:
+                # Consumed, but not removed before the previous process went down
+                os.unlink(self.segment_path(number))
+                continue
+            offset = head_offset if number == head_number else 0
+            size, records = self.scan_segment(number, offset)
+            if number == head_number:
+                self.read_offset = min(offset, size)
+            self.segments.append([number, size, records])
+            self.size += size
+            self.records += records
+        if self.segments and self.segments[0][0] != head_number:
+            self.read_offset = 0
+
+    def scan_segment(self, number, offset):
+        # Counts the records past offset, a record cut short (i.e. by a crash) is truncated.
+        path = self.segment_path(number)
+        size, records, valid = os.path.getsize(path), 0, 0
+        with open(path, 'rb') as f:
+            while True:
+                header = f.read(self.RECORD.size)
+                if len(header) < self.RECORD.size:
+                    break
+                length = self.RECORD.unpack(header)[0]
+                if valid + self.RECORD.size + length > size:
+                    break
+                f.seek(length, os.SEEK_CUR)
+                if valid >= offset:
+                    records += 1
+                valid += self.RECORD.size + length
+        if valid < size:
+            os.truncate(path, valid)
+        return valid, records
+
+    def append(self, data, timestamp=None):
+        record_size = self.RECORD.size + len(data)
+        with self.lock:
+            if record_size > self.max_size:
+                self.records_dropped += 1
+                return False
+            while self.size + record_size > self.max_size:
+                self.drop_segment()
+            if self.writer is None or self.segments[-1][1] >= self.segment_size:
+                self.rotate()
+            self.writer.write(self.RECORD.pack(len(data), timestamp or time.time()) + data)
+            segment = self.segments[-1]
+            segment[1] += record_size
+            segment[2] += 1
+            self.size += record_size
+            self.records += 1
+        return True
+
+    def rotate(self):
+        if self.writer:
+            self.writer.close()
+        number = self.segments[-1][0] + 1 if self.segments else self.head_number() + 1
+        self.writer = open(self.segment_path(number), 'ab', buffering=0)
+        self.segments.append([number, 0, 0])
+
+    def head_number(self):
+        head = os.pread(self.head, self.HEAD.size, 0)
+        return self.HEAD.unpack(head)[0] if len(head) == self.HEAD.size else 0
+
+    def drop_segment(self):
+        number, size, records = self.segments[0]
+        self.remove_segment()
+        self.records_dropped += records
+        self.records -= records
+
+    def remove_segment(self):
+        number, size, records = self.segments.pop(0)
+        if self.reader:
+            self.reader.close()
+            self.reader = None
+        if not self.segments and self.writer:
+            self.writer.close()
+            self.writer = None
+        os.unlink(self.segment_path(number))
+        self.size -= size
+        self.read_offset = 0
+        self.peeked = None
+        if self.segments:
+            os.pwrite(self.head, self.HEAD.pack(self.segments[0][0], 0), 0)
+
+    def peek(self):
+        # Returns (timestamp, data) of the oldest record, it stays in the queue until popped.
+        with self.lock:
+            if self.peeked is None and self.records:
+                number = self.segments[0][0]
+                if self.reader is None:
+                    self.reader = open(self.segment_path(number), 'rb')
+                    self.reader.seek(self.read_offset)
+                length, timestamp = self.RECORD.unpack(self.reader.read(self.RECORD.size))
+                self.peeked = timestamp, self.reader.read(length)
+            return self.peeked
+
+    def pop(self):
+        with self.lock:
+            if self.peeked is None:
+                return
+            timestamp, data = self.peeked
+            self.peeked = None
+            self.read_offset += self.RECORD.size + len(data)
+            segment = self.segments[0]
+            segment[2] -= 1
+            self.records -= 1
+            if segment[2] == 0 and (len(self.segments) > 1 or self.read_offset >= segment[1]):
+                self.remove_segment()
+            else:
+                os.pwrite(self.head, self.HEAD.pack(segment[0], self.read_offset), 0)
+
+    def close(self):
+        with self.lock:
+            for f in (self.reader, self.writer):
+                if f:
+                    f.close()
+            self.reader = self.writer = None
+            os.close(self.head)
@@ -15,16 +15,70 @@
 # Copyright 2011 Cloudant, Inc.
 
 
+import os
+import sys
+import copy
 import time
+import array
+import bisect
+import random
+import operator
+import resource
+import functools
+import itertools
 import socket
 import threading
+import multiprocessing
 import bucky3.module as module
+import bucky3.sketch as sketch
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-class StatsDServer(module.MetricsSrcProcess, module.UDPConnector):
-    def __init__(self, *args):
-        super().__init__(*args)
+
+class HistogramBins:
+    # Compiled histogram_bins boundaries, samples are counted in a flat list
+    # of (count, sum, sum of squares, min, max) per bin. A list rather than array,
+    # as array boxes floats on each access and ends up twice as slow.
+    __slots__ = ('boundaries', 'names')
+
+    def __init__(self, boundaries):
+        boundaries = sorted(boundaries)
+        if not boundaries:
+            raise ValueError("Histogram bins need at least one boundary")
+        self.boundaries = [float(b) for b in boundaries]
+        self.names = ['under_' + str(b) for b in boundaries] + ['over_' + str(boundaries[-1])]
+
+    def new_counts(self):
+        return [0, 0.0, 0.0, float('inf'), float('-inf')] * len(self.names)
+
+    def add(self, counts, val):
+        i = 5 * bisect.bisect_right(self.boundaries, val)
+        counts[i] += 1
+        counts[i + 1] += val
+        counts[i + 2] += val * val
+        if val < counts[i + 3]:
+            counts[i + 3] = val
+        if val > counts[i + 4]:
+            counts[i + 4] = val
+
+    def buckets(self, counts):
+        buckets = {}
+        for i, name in enumerate(self.names):
+            vlen, vsum, vsum_squares, vmin, vmax = counts[5 * i:5 * i + 5]
+            if vlen:
+                buckets[name] = vlen, vsum, vsum_squares, vmin, vmax
+        return buckets
+
+
+class StatsDServer(module.MetricsSrcProcess, module.UDPConnector, module.StreamListener):
+    def __init__(self, module_name, module_config, dst_pipes, rollup_pipes=()):
+        super().__init__(module_name, module_config, dst_pipes)
+        self.rollup_pipes = rollup_pipes
         self.sock = None
+        self.unix_sock = None
         self.timers = {}
         self.timers_lock = threading.Lock()
         self.histograms = {}
@@ -37,129 +91,584 @@ class StatsDServer(module.MetricsSrcProcess, module.UDPConnector):
         self.sets_lock = threading.Lock()
         self.last_timestamp = 0
         self.metrics_received = 0
+        self.datagrams_received = 0
+        self.datagrams_dropped = 0
+        self.datagrams_truncated = 0
+        self.bytes_received = 0
+        self.recv_stats_last = None
+        self.parse_errors = 0
+        self.metrics_sampled_out = 0
+        self.worker_pipes = []
+        self.worker_stats = {}
+        self.ingest_stall_time = 0
+        self.series = {}
+        self.series_total = 0
+        self.series_lock = threading.Lock()
+        self.series_overflows = {}
+        self.series_overflowed = 0
+        self.stream_connections = {}
+        self.stream_connections_accepted = 0
+        self.sampling_factor = 1
+        self.samples_seen = {}
+        self.samples_lock = threading.Lock()
+        self.sampling_round = 0
+        self.shedding_last = None
 
     def flush(self, system_timestamp):
-        self.enqueue_timers(system_timestamp)
-        self.enqueue_histograms(system_timestamp)
-        self.enqueue_counters(system_timestamp)
-        self.enqueue_gauges(system_timestamp)
-        self.enqueue_sets(system_timestamp)
+        # Fresh maps are swapped in, so the stats get calculated with no locks held
+        # and the ingest is never blocked for longer than the swap itself takes.
+        aggregates = self.take_aggregates()
+        if self.load_shedding:
+            # The ratio the aggregates were taken with, a new one takes effect from now on,
+            # workers are told along with the flush request, so they switch at the same time.
+            sampling_ratio = 1 / self.sampling_factor
+            self.adjust_sampling(*self.measure_load())
+        if self.worker_pipes:
+            self.merge_workers(aggregates)
+        self.enqueue_aggregates(system_timestamp, system_timestamp - self.last_timestamp, aggregates)
+        if self.load_shedding:
+            timestamp = system_timestamp if self.add_timestamps else None
+            self.buffer_metric('bucky3', {'sampling_ratio': sampling_ratio}, timestamp, {'name': self.name})
+        result = super().flush(system_timestamp)
+        if self.rollups:
+            self.flush_rollups(system_timestamp, aggregates)
         self.last_timestamp = system_timestamp
-        return super().flush(system_timestamp)
+        return result
+
+    def flush_rollups(self, system_timestamp, aggregates):
+        for i, rollup in enumerate(self.rollups):
+            # The last rollup takes over the aggregates, the others get copies, because buffers
+            # merged into an empty rollup would be shared and then appended to by all of them.
+            rollup_aggregates = aggregates if i == len(self.rollups) - 1 else self.copy_aggregates(aggregates)
+            if rollup['aggregates'] is None:
+                rollup['aggregates'], rollup['last_timestamp'] = rollup_aggregates, self.last_timestamp
+            else:
+                self.merge_aggregates(rollup['aggregates'], rollup_aggregates)
+            interval = system_timestamp - rollup['last_timestamp']
+            if self.align_flush:
+                # On multiples of the rollup flush_interval, the first window can be a partial one
+                remainder = system_timestamp % rollup['flush_interval']
+                due = min(remainder, rollup['flush_interval'] - remainder) < self.tick_interval / 2
+            else:
+                due = interval >= rollup['flush_interval'] - self.tick_interval / 2
+            if due:
+                self.enqueue_aggregates(system_timestamp, interval, rollup['aggregates'])
+                self.flush_buffer(rollup['dst_pipes'])
+                rollup['aggregates'], rollup['last_timestamp'] = ({}, {}, {}, {}, {}), system_timestamp
+
+    def copy_aggregates(self, aggregates):
+        timers, histograms, gauges, counters, sets = aggregates
+        return (
+            {k: (cust_timestamp, copy.copy(v)) for k, (cust_timestamp, v) in timers.items()},
+            {k: (cust_timestamp, selector, dict(buckets)) for k, (cust_timestamp, selector, buckets) in histograms.items()},
+            dict(gauges),
+            dict(counters),
+            {k: (cust_timestamp, copy.copy(v)) for k, (cust_timestamp, v) in sets.items()},
+        )
+
+    def enqueue_aggregates(self, system_timestamp, interval, aggregates):
+        timers, histograms, gauges, counters, sets = aggregates
+        self.enqueue_timers(system_timestamp, interval, timers)
+        self.enqueue_histograms(system_timestamp, interval, histograms)
+        self.enqueue_counters(system_timestamp, interval, counters)
+        self.enqueue_gauges(system_timestamp, gauges)
+        self.enqueue_sets(system_timestamp, sets)
 
     def init_cfg(self):
         super().init_cfg()
         percentile_thresholds = self.cfg.get('percentile_thresholds', ())
         self.percentile_thresholds = sorted(set(round(float(t), 2) for t in percentile_thresholds if t > 0 and t <= 100))
         self.histogram_selector = self.cfg.get('histogram_selector')
+        self.histogram_bins = [(dict(match), HistogramBins(boundaries)) for match, boundaries in self.cfg.get('histogram_bins', ())]
+        self.match_histogram_bins = functools.lru_cache(maxsize=10000)(self.find_histogram_bins)
         self.timestamp_window = self.cfg.get('timestamp_window', 600)
+        self.workers = max(self.cfg.get('workers', 1), 1)
+        self.rollups = [
+            {'flush_interval': rollup['flush_interval'], 'dst_pipes': dst_pipes, 'aggregates': None, 'last_timestamp': None}
+            for rollup, dst_pipes in itertools.zip_longest(self.cfg.get('rollups', ()), self.rollup_pipes, fillvalue=())
+        ]
+        for i, rollup in enumerate(self.rollups):
+            for m, pipe in zip(self.cfg['rollups'][i].get('destination_modules', ()), rollup['dst_pipes']):
+                self.dst_names[pipe] = '%s_rollup%d' % (m[0], i + 1)
+        # Apps tend to send the same names and tags over and over again, so cache the parsed keys.
+        # Note that the cached metadata dicts are shared, they must not be altered.
+        key_cache_size = self.cfg.get('key_cache_size', 10000)
+        if key_cache_size:
+            self.handle_name = functools.lru_cache(maxsize=key_cache_size)(self.parse_name)
+        else:
+            self.handle_name = self.parse_name
+        self.timer_engine = self.cfg.get('timer_engine', 'sort')
+        if self.timer_engine == 'numpy' and numpy is None:
+            self.log.warning("NumPy not available, using sort timer engine")
+            self.timer_engine = 'sort'
+        if self.timer_engine == 'numpy':
+            self.timer_buffer = lambda: array.array('d')
+            self.timer_percentiles = self.numpy_percentiles
+        elif self.timer_engine == 'select':
+            self.timer_buffer = list
+            self.timer_percentiles = self.select_percentiles
+        elif self.timer_engine == 'sketch':
+            accuracy = self.cfg.get('timer_sketch_accuracy', 0.01)
+            max_bins = self.cfg.get('timer_sketch_max_bins', 2048)
+            self.timer_buffer = lambda: sketch.DDSketch(accuracy, max_bins)
+            self.timer_percentiles = self.sketch_percentiles
+        else:
+            if self.timer_engine != 'sort':
+                self.log.warning("Unknown timer engine %s, using sort", self.timer_engine)
+                self.timer_engine = 'sort'
+            self.timer_buffer = list
+            self.timer_percentiles = self.sort_percentiles
+        self.cardinality_limit = self.cfg.get('cardinality_limit') or float('inf')
+        self.cardinality_limit_total = self.cfg.get('cardinality_limit_total') or float('inf')
+        self.cardinality_limited = self.cardinality_limit != float('inf') or self.cardinality_limit_total != float('inf')
+        self.cardinality_report_top = self.cfg.get('cardinality_report_top', 10)
+        self.set_engine = self.cfg.get('set_engine', 'exact')
+        self.set_hll_precision = self.cfg.get('set_hll_precision', 12)
+        if self.set_engine == 'hll':
+            self.set_hll_threshold = self.cfg.get('set_hll_threshold', 1000)
+        else:
+            if self.set_engine != 'exact':
+                self.log.warning("Unknown set engine %s, using exact", self.set_engine)
+                self.set_engine = 'exact'
+            self.set_hll_threshold = float('inf')
+        self.load_shedding = self.cfg.get('load_shedding', False)
+        self.shedding_cpu_threshold = self.cfg.get('shedding_cpu_threshold', 0.9)
+        self.shedding_backlog_threshold = self.cfg.get('shedding_backlog_threshold', 0.5)
+        self.shedding_max_factor = max(int(1 / self.cfg.get('shedding_min_ratio', 0.01)), 1)
 
     def read_loop(self):
-        sock = self.open_socket(bind=True)
+        self.init_recv()
         self.last_timestamp = round(time.time(), 3)
         while True:
             try:
-                data, addr = sock.recvfrom(65535)
-                self.handle_packet(data, addr)
-            except (InterruptedError, socket.timeout):
+                batch = self.recv_batch()
+                if batch:
+                    self.handle_datagrams(batch)
+            except InterruptedError:
                 pass
 
     def loop(self):
+        # The Unix socket is opened up front, so that workers inherit it and all read from it.
+        self.open_unix_socket()
+        if self.workers > 1:
+            self.start_workers()
         self.start_thread('UdpReadThread', self.read_loop)
+        # Stream listeners are only ever served by this process, workers take UDP traffic only.
+        if self.init_stream_listeners():
+            self.start_thread('StreamReadThread', self.stream_loop)
         super().loop()
 
+    def start_workers(self):
+        # Workers are forked before any thread is started. Each of them binds its own socket to the same
+        # endpoint (SO_REUSEPORT) and lets the kernel spread the traffic. Workers only parse and aggregate,
+        # on flush this process collects their partial aggregates and merges them into its own.
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            self.log.warning("SO_REUSEPORT not available, running a single worker")
+            return
+        for i in range(1, self.workers):
+            module_end, worker_end = multiprocessing.Pipe()
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    module_end.close()
+                    for pipe in self.worker_pipes:
+                        pipe.close()
+                    self.worker_pipes = []
+                    self.worker_loop(worker_end)
+                finally:
+                    os._exit(0)
+            worker_end.close()
+            self.worker_pipes.append(module_end)
+            self.log.info("Started worker %d, pid %d", i, pid)
+
+    def worker_loop(self, pipe):
+        self.start_thread('UdpReadThread', self.read_loop)
+        while True:
+            try:
+                sampling_factor = pipe.recv()
+            except InterruptedError:
+                continue
+            except EOFError:
+                # The module process is gone, so should we.
+                return
+            if self.ended_threads():
+                return
+            aggregates = self.take_aggregates()
+            if sampling_factor is not None:
+                self.sampling_factor = sampling_factor
+            ingest_stats = self.ingest_stats()
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            ingest_stats['worker_cpu'] = round(usage.ru_utime + usage.ru_stime, 3)
+            pipe.send((aggregates, ingest_stats, self.take_series_overflows()))
+
+    def merge_workers(self, aggregates):
+        for pipe in self.worker_pipes:
+            pipe.send(self.sampling_factor)
+        for i, pipe in enumerate(self.worker_pipes):
+            try:
+                if not pipe.poll(self.tick_interval):
+                    raise EOFError()
+                worker_aggregates, self.worker_stats[i], worker_overflows = pipe.recv()
+            except (EOFError, OSError):
+                self.log.error("Worker %d is not responding, aborting", i + 1)
+                sys.exit(1)
+            self.merge_aggregates(aggregates, worker_aggregates)
+            self.merge_counts(self.series_overflows, worker_overflows)
+
+    def take_aggregates(self):
+        stall_start = time.perf_counter()
+        with self.timers_lock:
+            timers, self.timers = self.timers, {}
+        with self.histograms_lock:
+            histograms, self.histograms = self.histograms, {}
+        with self.gauges_lock:
+            gauges, self.gauges = self.gauges, {}
+        with self.counters_lock:
+            counters, self.counters = self.counters, {}
+        with self.sets_lock:
+            sets, self.sets = self.sets, {}
+        # Cardinality budgets and sampling phases are per flush interval, like the maps above.
+        with self.series_lock:
+            self.series, self.series_total = {}, 0
+        with self.samples_lock:
+            self.samples_seen = {}
+            self.sampling_round += 1
+        self.ingest_stall_time += time.perf_counter() - stall_start
+        # Selectors may well be lambdas that don't pickle, and they are not needed past this point anyway.
+        # Compiled bins get their compact counts unpacked into the same form the selectors produce.
+        histograms = {
+            k: (cust_timestamp, None, selector.buckets(buckets) if isinstance(selector, HistogramBins) else buckets)
+            for k, (cust_timestamp, selector, buckets) in histograms.items()
+        }
+        return timers, histograms, gauges, counters, sets
+
+    def merge_aggregates(self, dst, src):
+        # Both dst and src are detached from ingest, so no locking here.
+        self.merge_timers(dst[0], src[0])
+        self.merge_histograms(dst[1], src[1])
+        dst[2].update(src[2])
+        self.merge_counters(dst[3], src[3])
+        self.merge_sets(dst[4], src[4])
+
+    def merge_timers(self, dst, src):
+        for k, (cust_timestamp, v) in src.items():
+            if k in dst:
+                buf = dst[k][1]
+                if isinstance(buf, sketch.DDSketch):
+                    buf.merge(v)
+                else:
+                    buf.extend(v)
+                dst[k] = cust_timestamp, buf
+            else:
+                dst[k] = cust_timestamp, v
+
+    def merge_histograms(self, dst, src):
+        for k, (cust_timestamp, selector, buckets) in src.items():
+            if k in dst:
+                dst_buckets = dst[k][2]
+                for histogram_bucket, (vlen, vsum, vsum_squares, vmin, vmax) in buckets.items():
+                    bucket_stats = dst_buckets.get(histogram_bucket)
+                    if bucket_stats:
+                        vlen2, vsum2, vsum_squares2, vmin2, vmax2 = bucket_stats
+                        dst_buckets[histogram_bucket] = (
+                            vlen + vlen2, vsum + vsum2, vsum_squares + vsum_squares2, min(vmin, vmin2), max(vmax, vmax2)
+                        )
+                    else:
+                        dst_buckets[histogram_bucket] = vlen, vsum, vsum_squares, vmin, vmax
+                dst[k] = cust_timestamp, dst[k][1], dst_buckets
+            else:
+                dst[k] = cust_timestamp, selector, buckets
+
+    def merge_counters(self, dst, src):
+        for k, (cust_timestamp, v) in src.items():
+            if k in dst:
+                v += dst[k][1]
+            dst[k] = cust_timestamp, v
+
+    def merge_sets(self, dst, src):
+        for k, (cust_timestamp, v) in src.items():
+            if k in dst:
+                buf = dst[k][1]
+                if isinstance(v, sketch.HyperLogLog) and not isinstance(buf, sketch.HyperLogLog):
+                    buf, v = v, buf
+                buf.update(v)
+                if buf.__class__ is set and len(buf) > self.set_hll_threshold:
+                    buf = sketch.HyperLogLog(self.set_hll_precision, buf)
+                dst[k] = cust_timestamp, buf
+            else:
+                dst[k] = cust_timestamp, v
+
+    def take_series_overflows(self):
+        with self.series_lock:
+            series_overflows, self.series_overflows = self.series_overflows, {}
+        return series_overflows
+
+    def merge_counts(self, dst, src):
+        for k, v in src.items():
+            dst[k] = dst.get(k, 0) + v
+
+    def measure_load(self):
+        # Returns the CPU used by this process and its workers since the last call, as a fraction
+        # of a core per process, and how full the receive queues are, as a fraction of their buffers.
+        # Worker stats come with the flush, so their share of CPU lags one interval behind.
+        processes = len(self.worker_pipes) + 1
+        now = time.perf_counter()
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        cpu_time = usage.ru_utime + usage.ru_stime
+        cpu_time += sum(worker_stats.get('worker_cpu', 0) for worker_stats in self.worker_stats.values())
+        cpu_load = 0
+        if self.shedding_last:
+            last_timestamp, last_cpu_time = self.shedding_last
+            if now > last_timestamp:
+                cpu_load = (cpu_time - last_cpu_time) / (now - last_timestamp) / processes
+        self.shedding_last = now, cpu_time
+        backlog = 0
+        queue_stats = self.recv_queue_stats()
+        if queue_stats:
+            recv_queue_bytes = queue_stats[0]
+            recv_queue_bytes += sum(worker_stats.get('recv_queue_bytes', 0) for worker_stats in self.worker_stats.values())
+            recv_buffer_size = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+            backlog = recv_queue_bytes / (recv_buffer_size * processes)
+        return cpu_load, backlog
+
+    def adjust_sampling(self, cpu_load, backlog):
+        # Sampling is stepped up twofold per interval while overloaded and stepped down the same way
+        # once the load is well under the thresholds. The gap between the two avoids flapping.
+        if cpu_load > self.shedding_cpu_threshold or backlog > self.shedding_backlog_threshold:
+            sampling_factor = min(self.sampling_factor * 2, self.shedding_max_factor)
+        elif cpu_load < self.shedding_cpu_threshold / 2 and backlog < self.shedding_backlog_threshold / 2:
+            sampling_factor = max(self.sampling_factor // 2, 1)
+        else:
+            sampling_factor = self.sampling_factor
+        if sampling_factor != self.sampling_factor:
+            self.log.info("Sampling ratio changed to 1/%d (cpu %.2f, backlog %.2f)", sampling_factor, cpu_load, backlog)
+            self.sampling_factor = sampling_factor
+
+    def take_sample(self, key):
+        # Deterministic 1 in sampling_factor sampling per key within a flush interval. The phase
+        # changes from interval to interval, so that a key with fewer samples than sampling_factor
+        # per interval is not kept (and scaled up) or dropped in every interval, but is right
+        # on average over time.
+        with self.samples_lock:
+            n = self.samples_seen.get(key)
+            if n is None:
+                n = hash((key, self.sampling_round)) % self.sampling_factor
+            self.samples_seen[key] = n + 1
+        return n % self.sampling_factor == 0
+
+    def ingest_stats(self):
+        ingest_stats = {
+            'metrics_received': self.metrics_received,
+            'parse_errors': self.parse_errors,
+            'metrics_sampled_out': self.metrics_sampled_out,
+            'ingest_stall_time': round(self.ingest_stall_time, 6),
+        }
+        if hasattr(self.handle_name, 'cache_info'):
+            cache_info = self.handle_name.cache_info()
+            ingest_stats['key_cache_hits'] = cache_info.hits
+            ingest_stats['key_cache_misses'] = cache_info.misses
+        if self.cardinality_limited:
+            ingest_stats['series_overflows'] = self.series_overflowed
+        if self.stream_connections_accepted:
+            ingest_stats['stream_connections'] = len(self.stream_connections)
+            ingest_stats['stream_connections_accepted'] = self.stream_connections_accepted
+        ingest_stats.update(self.recv_stats())
+        return ingest_stats
+
     def produce_self_report(self):
         self_report = super().produce_self_report()
-        self_report['metrics_received'] = self.metrics_received
+        self_report.update(self.ingest_stats())
+        for worker_stats in self.worker_stats.values():
+            for k, v in worker_stats.items():
+                self_report[k] = self_report.get(k, 0) + v
         return self_report
 
-    def enqueue_timers(self, system_timestamp):
-        interval = system_timestamp - self.last_timestamp
+    def produce_self_report_details(self):
+        # Top offenders of the cardinality limits since the last self report
+        series_overflows = self.take_series_overflows()
+        top = sorted(series_overflows.items(), key=lambda i: i[1], reverse=True)[:self.cardinality_report_top]
+        for name, count in top:
+            yield {'overflow_name': name}, {'series_overflows': count}
+        yield from self.stream_self_report()
+        yield from super().produce_self_report_details()
+
+    def enqueue_timers(self, system_timestamp, interval, timers):
         bucket = self.cfg['timers_bucket']
         timestamp = system_timestamp if self.add_timestamps else None
-        with self.timers_lock:
-            for k, (cust_timestamp, v) in self.timers.items():
-                v.sort()
-                count = len(v)
-                thresholds = ((count if t == 100 else (t * count) // 100, t) for t in self.percentile_thresholds)
+        for k, (cust_timestamp, v) in timers.items():
+            for t, (vlen, vsum, vsum_squares, vmin, vmax) in self.timer_percentiles(v):
+                mean = vsum / vlen
+                stats = {'count': vlen, 'count_ps': vlen / interval, 'lower': vmin, 'upper': vmax, 'mean': mean}
+                if vlen > 1:
+                    var = (vsum_squares - 2 * mean * vsum + vlen * mean * mean) / (vlen - 1)
+                    # FP rounding can lead to negative variance and in consequence complex stdev.
+                    # I.e. three samples of [0.003, 0.003, 0.003]
+                    var = max(var, 0)
+                    stats['stdev'] = var ** 0.5
+                metadata = {'percentile': str(t)}
+                metadata.update(k)
+                self.buffer_metric(bucket, stats, cust_timestamp or timestamp, metadata)
 
-                try:
+    def sort_percentiles(self, v):
+        # Yields (threshold, (count, sum, sum of squares, lower, upper)) for each percentile threshold.
+        v.sort()
+        count = len(v)
+        thresholds = ((count if t == 100 else (t * count) // 100, t) for t in self.percentile_thresholds)
+
+        try:
+            next_i, next_t = next(thresholds)
+            vlen = vsum = vsum_squares = 0
+            for i, x in enumerate(v):
+                vlen += 1
+                vsum += x
+                vsum_squares += x * x
+                while i >= next_i - 1:
+                    yield next_t, (vlen, vsum, vsum_squares, v[0], x)
                     next_i, next_t = next(thresholds)
-                    vlen = vsum = vsum_squares = 0
-                    for i, x in enumerate(v):
-                        vlen += 1
-                        vsum += x
-                        vsum_squares += x * x
-                        while i >= next_i - 1:
-                            mean = vsum / vlen
-                            stats = {'count': vlen, 'count_ps': vlen / interval, 'lower': v[0], 'upper': x, 'mean': mean}
-                            if vlen > 1:
-                                var = (vsum_squares - 2 * mean * vsum + vlen * mean * mean) / (vlen - 1)
-                                # FP rounding can lead to negative variance and in consequence complex stdev.
-                                # I.e. three samples of [0.003, 0.003, 0.003]
-                                var = max(var, 0)
-                                stats['stdev'] = var ** 0.5
-                            metadata = {'percentile': str(next_t)}
-                            metadata.update(k)
-                            self.buffer_metric(bucket, stats, cust_timestamp or timestamp, metadata)
-                            next_i, next_t = next(thresholds)
-                except StopIteration:
-                    pass
-            self.timers = {}
-
-    def enqueue_histograms(self, system_timestamp):
-        interval = system_timestamp - self.last_timestamp
+        except StopIteration:
+            pass
+
+    def numpy_percentiles(self, v):
+        # For a handful of samples, the NumPy call overhead outweighs the gains.
+        if len(v) < 64:
+            yield from self.sort_percentiles(v.tolist())
+            return
+        a = numpy.frombuffer(v, dtype=numpy.float64)
+        count = len(a)
+        ranks = [max(count if t == 100 else int((t * count) // 100), 1) for t in self.percentile_thresholds]
+        # Partitioning around all ranks in one go leaves every prefix with the right samples,
+        # they are not sorted within, but sums don't care about the order.
+        a = numpy.partition(a, [0] + [r - 1 for r in ranks])
+        vsums, vsums_squares = numpy.cumsum(a), numpy.cumsum(a * a)
+        vmin = float(a[0])
+        for t, r in zip(self.percentile_thresholds, ranks):
+            yield t, (r, float(vsums[r - 1]), float(vsums_squares[r - 1]), vmin, float(a[r - 1]))
+
+    def select_percentiles(self, v):
+        count = len(v)
+        if count < 64:
+            yield from self.sort_percentiles(v)
+            return
+        ranks = [max(count if t == 100 else int((t * count) // 100), 1) for t in self.percentile_thresholds]
+        if not ranks:
+            return
+        last_rank, prefixes = max(ranks), {}
+        vmin, vlen, vsum, vsum_squares = min(v), 0, 0, 0
+        for chunk, upper in self.select_chunks(v, sorted(set(ranks))):
+            vlen += len(chunk)
+            vsum += sum(chunk)
+            vsum_squares += sum(map(operator.mul, chunk, chunk))
+            if upper is not None:
+                prefixes[vlen] = (vlen, vsum, vsum_squares, vmin, upper)
+            if vlen >= last_rank:
+                break
+        for t, r in zip(self.percentile_thresholds, ranks):
+            yield t, prefixes[r]
+
+    def select_chunks(self, v, ranks):
+        # Quickselect for multiple ranks at once, yields (chunk, upper) where the chunks are consecutive
+        # slices of sorted v, though unsorted within. A chunk ends at each of the (ascending) ranks and
+        # its upper is the rank-th smallest sample, other chunks come with upper None.
+        if not ranks:
+            yield v, None
+            return
+        if len(v) <= 16:
+            v = sorted(v)
+            i = 0
+            for r in ranks:
+                yield v[i:r], v[r - 1]
+                i = r
+            if i < len(v):
+                yield v[i:], None
+            return
+        pivot = sorted(v[random.randrange(len(v))] for i in range(3))[1]
+        lows = [x for x in v if x < pivot]
+        highs = [x for x in v if x > pivot]
+        i, j = len(lows), len(v) - len(highs)
+        yield from self.select_chunks(lows, [r for r in ranks if r <= i])
+        for r in ranks:
+            if i < r <= j:
+                yield [pivot] * (r - i), pivot
+                i = r
+        if i < j:
+            yield [pivot] * (j - i), None
+        yield from self.select_chunks(highs, [r - j for r in ranks if r > j])
+
+    def sketch_percentiles(self, v):
+        count = v.count
+        # Same ranks as in sort_percentiles, where the rank 0 ends up being the first sample.
+        ranks = [max(count if t == 100 else int((t * count) // 100), 1) for t in self.percentile_thresholds]
+        for t, (vlen, vsum, vsum_squares, vmax) in zip(self.percentile_thresholds, v.prefixes(ranks)):
+            yield t, (vlen, vsum, vsum_squares, v.min, vmax)
+
+    def enqueue_histograms(self, system_timestamp, interval, histograms):
         bucket = self.cfg['histograms_bucket']
         timestamp = system_timestamp if self.add_timestamps else None
-        with self.histograms_lock:
-            for k, (cust_timestamp, selector, buckets) in self.histograms.items():
-                for histogram_bucket, (vlen, vsum, vsum_squares, vmin, vmax) in buckets.items():
-                    mean = vsum / vlen
-                    stats = {'count': vlen, 'count_ps': vlen / interval, 'lower': vmin, 'upper': vmax, 'mean': mean}
-                    if vlen > 1:
-                        var = (vsum_squares - 2 * mean * vsum + vlen * mean * mean) / (vlen - 1)
-                        var = max(var, 0)
-                        stats['stdev'] = var ** 0.5
-                    metadata = {'histogram': str(histogram_bucket)}
-                    metadata.update(k)
-                    self.buffer_metric(bucket, stats, cust_timestamp or timestamp, metadata)
-            self.histograms = {}
-
-    def enqueue_sets(self, system_timestamp):
+        for k, (cust_timestamp, selector, buckets) in histograms.items():
+            for histogram_bucket, (vlen, vsum, vsum_squares, vmin, vmax) in buckets.items():
+                mean = vsum / vlen
+                stats = {'count': vlen, 'count_ps': vlen / interval, 'lower': vmin, 'upper': vmax, 'mean': mean}
+                if vlen > 1:
+                    var = (vsum_squares - 2 * mean * vsum + vlen * mean * mean) / (vlen - 1)
+                    var = max(var, 0)
+                    stats['stdev'] = var ** 0.5
+                metadata = {'histogram': str(histogram_bucket)}
+                metadata.update(k)
+                self.buffer_metric(bucket, stats, cust_timestamp or timestamp, metadata)
+
+    def enqueue_sets(self, system_timestamp, sets):
         bucket = self.cfg['sets_bucket']
         timestamp = system_timestamp if self.add_timestamps else None
-        with self.sets_lock:
-            for k, (cust_timestamp, v) in self.sets.items():
-                self.buffer_metric(bucket, {"count": len(v)}, cust_timestamp or timestamp, dict(k))
-            self.sets = {}
+        for k, (cust_timestamp, v) in sets.items():
+            self.buffer_metric(bucket, {"count": len(v)}, cust_timestamp or timestamp, dict(k))
 
-    def enqueue_gauges(self, system_timestamp):
+    def enqueue_gauges(self, system_timestamp, gauges):
         bucket = self.cfg['gauges_bucket']
         timestamp = system_timestamp if self.add_timestamps else None
-        with self.gauges_lock:
-            for k, (cust_timestamp, v) in self.gauges.items():
-                self.buffer_metric(bucket, {"value": float(v)}, cust_timestamp or timestamp, dict(k))
-            self.gauges = {}
+        for k, (cust_timestamp, v) in gauges.items():
+            self.buffer_metric(bucket, {"value": float(v)}, cust_timestamp or timestamp, dict(k))
 
-    def enqueue_counters(self, system_timestamp):
-        interval = system_timestamp - self.last_timestamp
+    def enqueue_counters(self, system_timestamp, interval, counters):
         bucket = self.cfg['counters_bucket']
         timestamp = system_timestamp if self.add_timestamps else None
-        with self.counters_lock:
-            for k, (cust_timestamp, v) in self.counters.items():
-                stats = {
-                    'rate': float(v) / interval,
-                    'count': float(v)
-                }
-                self.buffer_metric(bucket, stats, cust_timestamp or timestamp, dict(k))
-            self.counters = {}
+        for k, (cust_timestamp, v) in counters.items():
+            stats = {
+                'rate': float(v) / interval,
+                'count': float(v)
+            }
+            self.buffer_metric(bucket, stats, cust_timestamp or timestamp, dict(k))
 
     def handle_packet(self, data, addr=None):
         # Adding a bit of extra sauce so clients can send multiple samples in a single UDP packet.
         try:
             recv_timestamp, data = round(time.time(), 3), data.decode("ascii")
         except UnicodeDecodeError:
+            self.parse_errors += 1
+            return
+        self.handle_lines(recv_timestamp, data)
+
+    def handle_datagrams(self, datagrams):
+        # Decode and split the whole batch in one go, only if it contains
+        # a malformed datagram, we fall back to handling them one by one.
+        try:
+            recv_timestamp, data = round(time.time(), 3), b"\n".join(datagrams).decode("ascii")
+        except UnicodeDecodeError:
+            for data in datagrams:
+                self.handle_packet(data)
             return
+        self.handle_lines(recv_timestamp, data)
+
+    def handle_stream_lines(self, data):
+        try:
+            recv_timestamp, data = round(time.time(), 3), data.decode("ascii")
+        except UnicodeDecodeError:
+            # Unlike with datagrams, a malformed line doesn't spoil the rest of the chunk.
+            for line in data.split(b"\n"):
+                self.handle_packet(line)
+            return
+        self.handle_lines(recv_timestamp, data)
+
+    def handle_lines(self, recv_timestamp, data):
         for line in data.splitlines():
             line = line.strip()
             if line:
@@ -169,26 +678,33 @@ class StatsDServer(module.MetricsSrcProcess, module.UDPConnector):
         # DataDog special packets for service check and events, ignore them
         if line.startswith('sc|') or line.startswith('_e{'):
             return
-        try:
-            cust_timestamp, line, metadata = self.handle_metadata(recv_timestamp, line)
-        except ValueError:
-            return
-        if not line:
-            return
+        # http://docs.datadoghq.com/guides/dogstatsd/#datagram-format
+        line, _, tags = line.partition("|#")  # We allow '#' in tag values, too
         bits = line.split(":")
         if len(bits) < 2:
+            self.parse_errors += 1
             return
         name = bits.pop(0)
-        if not name.isidentifier():
+        try:
+            if 'timestamp=' in tags:
+                # Custom timestamps make the outcome time dependent, these lines always take the long way.
+                cust_timestamp, key, metadata = self.handle_metadata(recv_timestamp, name, tags)
+            else:
+                cust_timestamp = None
+                key, metadata = self.handle_name(name, tags)
+        except ValueError:
+            self.parse_errors += 1
             return
-        key, metadata = self.handle_key(name, metadata)
         if not key:
             return
+        if self.cardinality_limited:
+            key, metadata = self.limit_cardinality(name, key, metadata)
 
         # I'm not sure if statsd is doing this on purpose but the code allows for name:v1|t1:v2|t2 etc.
         # In the interest of compatibility, I'll maintain the behavior.
         for sample in bits:
             if "|" not in sample:
+                self.parse_errors += 1
                 continue
             fields = sample.split("|")
             valstr = fields[0]
@@ -197,25 +713,26 @@ class StatsDServer(module.MetricsSrcProcess, module.UDPConnector):
             typestr = fields[1]
             ratestr = fields[2] if len(fields) > 2 else None
             try:
-                if typestr == "ms" or typestr == "h":
-                    self.handle_timer(cust_timestamp, key, metadata, valstr, ratestr)
-                elif typestr == "g":
+                if typestr == "g":
+                    # Gauges are never sampled, the last value is what counts
                     self.handle_gauge(cust_timestamp, key, metadata, valstr, ratestr)
+                elif self.sampling_factor > 1 and not self.take_sample(key):
+                    self.metrics_sampled_out += 1
+                elif typestr == "ms" or typestr == "h":
+                    self.handle_timer(cust_timestamp, key, metadata, valstr, ratestr)
                 elif typestr == "s":
                     self.handle_set(cust_timestamp, key, metadata, valstr, ratestr)
                 else:
                     self.handle_counter(cust_timestamp, key, metadata, valstr, ratestr)
                 self.metrics_received += 1
             except ValueError:
-                pass
+                self.parse_errors += 1
 
-    def handle_metadata(self, recv_timestamp, line):
-        # http://docs.datadoghq.com/guides/dogstatsd/#datagram-format
-        bits = line.split("|#", 1)  # We allow '#' in tag values, too
+    def handle_metadata(self, recv_timestamp, name, tags):
+        if not name.isidentifier():
+            raise ValueError()
         cust_timestamp, metadata = None, {}
-        if len(bits) < 2:
-            return cust_timestamp, line, metadata
-        for i in bits[1].split(","):
+        for i in tags.split(","):
             if not i:
                 continue
             # Due to how we parse the metadata, comma is the only illegal character
@@ -239,13 +756,43 @@ class StatsDServer(module.MetricsSrcProcess, module.UDPConnector):
                 metadata[k] = v
             else:
                 metadata[k] = v
-        return cust_timestamp, bits[0], metadata
+        key, metadata = self.handle_key(name, metadata)
+        return cust_timestamp, key, metadata
+
+    def parse_name(self, name, tags):
+        # Only ever called for tags without timestamp, the outcome depends on name and tags alone.
+        cust_timestamp, key, metadata = self.handle_metadata(None, name, tags)
+        return key, metadata
 
     def handle_key(self, name, metadata):
         metadata.update(name=name)
         key = tuple((k, metadata[k]) for k in sorted(metadata.keys()))
         return key, metadata
 
+    def limit_cardinality(self, name, key, metadata):
+        # This has to run past the key cache, budgets are per flush interval and the cache is not.
+        with self.series_lock:
+            keys = self.series.get(name)
+            if keys is not None and key in keys:
+                return key, metadata
+            if self.series_total < self.cardinality_limit_total:
+                if keys is None:
+                    keys = self.series[name] = set()
+                if len(keys) < self.cardinality_limit:
+                    keys.add(key)
+                    self.series_total += 1
+                    return key, metadata
+            else:
+                # Once the global budget is exhausted, unknown names all share the same overflow series.
+                if keys is None:
+                    name = '__overflow__'
+            self.series_overflows[name] = self.series_overflows.get(name, 0) + 1
+            self.series_overflowed += 1
+        overflow_metadata = {'series': '__overflow__'}
+        if 'bucket' in metadata:
+            overflow_metadata['bucket'] = metadata['bucket']
+        return self.handle_key(name, overflow_metadata)
+
     def handle_timer(self, cust_timestamp, key, metadata, valstr, ratestr):
         val = float(valstr)
 
@@ -255,21 +802,33 @@ class StatsDServer(module.MetricsSrcProcess, module.UDPConnector):
                 buf.append(val)
                 self.timers[key] = cust_timestamp, buf
             else:
-                self.timers[key] = cust_timestamp, [val]
+                buf = self.timer_buffer()
+                buf.append(val)
+                self.timers[key] = cust_timestamp, buf
 
-        if self.histogram_selector is None:
+        if self.histogram_selector is None and not self.histogram_bins:
             return
 
         with self.histograms_lock:
             histogram = self.histograms.get(key)
             if histogram is None:
-                selector = self.histogram_selector(metadata)
-                if selector is None:
+                selector = self.match_histogram_bins(key) if self.histogram_bins else None
+                if selector is not None:
+                    buckets = selector.new_counts()
+                elif self.histogram_selector is not None:
+                    selector = self.histogram_selector(metadata)
+                    if selector is None:
+                        return
+                    buckets = {}
+                else:
                     return
-                buckets = {}
             else:
                 selector = histogram[1]
                 buckets = histogram[2]
+            if selector.__class__ is HistogramBins:
+                selector.add(buckets, val)
+                self.histograms[key] = cust_timestamp, selector, buckets
+                return
             bucket_name = selector(val)
             if bucket_name:
                 bucket_stats = buckets.get(bucket_name)
@@ -283,6 +842,13 @@ class StatsDServer(module.MetricsSrcProcess, module.UDPConnector):
                 )
                 self.histograms[key] = cust_timestamp, selector, buckets
 
+    def find_histogram_bins(self, key):
+        metadata = dict(key)
+        for match, bins in self.histogram_bins:
+            if all(metadata.get(k) == v for k, v in match.items()):
+                return bins
+        return None
+
     def handle_gauge(self, cust_timestamp, key, metadata, valstr, ratestr):
         val = float(valstr)
         delta = valstr[0] in "+-"
@@ -297,6 +863,8 @@ class StatsDServer(module.MetricsSrcProcess, module.UDPConnector):
             if key in self.sets:
                 buf = self.sets[key][1]
                 buf.add(valstr)
+                if buf.__class__ is set and len(buf) > self.set_hll_threshold:
+                    buf = sketch.HyperLogLog(self.set_hll_precision, buf)
                 self.sets[key] = cust_timestamp, buf
             else:
                 self.sets[key] = cust_timestamp, {valstr}
@@ -310,6 +878,8 @@ class StatsDServer(module.MetricsSrcProcess, module.UDPConnector):
                 return
         else:
             val = float(valstr)
+        if self.sampling_factor > 1:
+            val *= self.sampling_factor
         with self.counters_lock:
             if key in self.counters:
                 val += self.counters[key][1]
@@ -0,0 +1,198 @@
+
+
+import os
+import time
+import random
+import string
+import unittest
+import multiprocessing
+import multiprocessing.connection
+import bucky3.ipc as ipc
+
+
+def rand_str(min_len=3, max_len=10):
+    return ''.join(random.choice(string.ascii_lowercase) for i in range(random.randint(min_len, max_len)))
+
+
+def rand_chunk(length):
+    return [
+        (
+            'stats_timers',
+            {'count': 10, 'count_ps': 1.0, 'lower': random.random(), 'upper': random.random(), 'mean': random.random()},
+            round(time.time(), 3),
+            {'name': rand_str(), 'host': 'localhost', 'percentile': '90.0', rand_str(): rand_str()},
+        )
+        for i in range(length)
+    ]
+
+
+class UnmarshallableValue(float):
+    pass
+
+
+class TestInterning(unittest.TestCase):
+    def test_roundtrip(self):
+        encoder, decoder = ipc.Encoder(), ipc.Decoder()
+        metadata_sets = [{'name': rand_str(), 'host': 'localhost'} for i in range(5)]
+        for i in range(10):
+            chunk = [(rand_str(), {'value': random.random()}, None, dict(random.choice(metadata_sets))) for j in range(20)]
+            data = encoder.encode(chunk)
+            assert data[:1] == b'i'
+            assert ipc.decode(data, decoder) == chunk
+        # Only the new entries go along, decoded metadata is shared
+        chunk = [('foo', {'value': 1}, None, dict(metadata_sets[0])), ('foo', {'value': 2}, None, dict(metadata_sets[0]))]
+        assert ipc.decode(encoder.encode(chunk), decoder) == chunk
+        data = encoder.encode(chunk)
+        base, definitions, entries = ipc.marshal.loads(data[1:])
+        assert not definitions
+        decoded = ipc.decode(data, decoder)
+        assert decoded == chunk
+        assert decoded[0][3] is decoded[1][3]
+        with self.assertRaises(ValueError):
+            ipc.decode(encoder.encode(chunk))
+
+    def test_sessions(self):
+        encoder, decoder = ipc.Encoder(max_entries=10), ipc.Decoder()
+        chunks = [[('foo', {'value': i}, None, {'name': str(i)})] for i in range(20)]
+        # The decoder misses the start of the session and drops what it can't decode
+        encoder.encode(chunks[0])
+        for chunk in chunks[1:9]:
+            assert ipc.decode(encoder.encode(chunk), decoder) == []
+        assert decoder.dropped == 8
+        # Until the next session starts
+        for chunk in chunks[9:]:
+            assert ipc.decode(encoder.encode(chunk), decoder) == chunk
+        assert len(decoder.table) <= 10
+
+    def test_fallback(self):
+        encoder, decoder = ipc.Encoder(), ipc.Decoder()
+        chunk = [('foo', {'value': 1}, None, {'name': 'bar'})]
+        assert ipc.decode(encoder.encode(chunk), decoder) == chunk
+        odd_chunk = [('foo', {'value': UnmarshallableValue(1)}, None, {'name': 'bar'}), ('foo', 1)]
+        data = encoder.encode(odd_chunk)
+        assert data[:1] == b'p'
+        assert ipc.decode(data, decoder) == odd_chunk
+        assert ipc.decode(encoder.encode(chunk), decoder) == chunk
+        assert decoder.dropped == 0
+
+    def test_interning_performance(self):
+        flag = os.environ.get('TEST_PERFORMANCE', 'no').lower()
+        if flag not in ('yes', 'true', '1'):
+            self.skipTest("Performance test not requested")
+        metadata_sets = [{'name': rand_str(), 'host': 'localhost', 'percentile': '90.0', rand_str(): rand_str()} for i in range(1000)]
+        chunks = [
+            [('stats_timers', {'count': 10, 'mean': random.random()}, None, dict(random.choice(metadata_sets))) for j in range(300)]
+            for i in range(1000)
+        ]
+        encoder, decoder = ipc.Encoder(), ipc.Decoder()
+        for name, encode, decode in (
+            ('plain', ipc.encode, ipc.decode),
+            ('interned', encoder.encode, lambda data: ipc.decode(data, decoder)),
+        ):
+            start_time = time.process_time()
+            encoded = [encode(chunk) for chunk in chunks]
+            encode_time = time.process_time() - start_time
+            start_time = time.process_time()
+            for data in encoded:
+                decode(data)
+            decode_time = time.process_time() - start_time
+            size = sum(len(data) for data in encoded)
+            print("\n%s: encode %.3fs, decode %.3fs, %d bytes" % (name, encode_time, decode_time, size))
+
+
+@unittest.skipIf(ipc.shared_memory is None, "Shared memory not available")
+class TestShmPipe(unittest.TestCase):
+    def setUp(self):
+        self.rings = []
+
+    def tearDown(self):
+        for ring in self.rings:
+            ring.unlink()
+
+    def shm_pipe(self, size):
+        recv_end, send_end, ring = ipc.shm_pipe(size)
+        self.rings.append(ring)
+        return recv_end, send_end
+
+    def test_codec(self):
+        chunk = rand_chunk(10)
+        data = ipc.encode(chunk)
+        assert data[:1] == b'm'
+        assert ipc.decode(data) == chunk
+        chunk.append(('foo', {'value': UnmarshallableValue(1)}, None, {}))
+        data = ipc.encode(chunk)
+        assert data[:1] == b'p'
+        assert ipc.decode(data) == chunk
+        with self.assertRaises(ValueError):
+            ipc.decode(b'x')
+
+    def test_wraparound(self):
+        recv_end, send_end = self.shm_pipe(1000)
+        sent, received = [], []
+        for i in range(500):
+            chunk = [rand_str(1, 100) for j in range(random.randint(0, 5))]
+            sent.extend(chunk)
+            send_end.send(chunk)
+            if random.random() < 0.3:
+                while recv_end.poll():
+                    received.extend(recv_end.recv())
+        while recv_end.poll():
+            received.extend(recv_end.recv())
+        assert received == sent
+
+    def test_overflow(self):
+        # What doesn't fit in the ring goes through the pipe, in order
+        recv_end, send_end = self.shm_pipe(100)
+        chunks = [['a' * 10], ['b' * 200], ['c' * 10], ['d' * 50], ['e' * 50], ['f' * 10]]
+        for chunk in chunks:
+            send_end.send(chunk)
+        received = []
+        while recv_end.poll():
+            received.extend(recv_end.recv())
+        assert received == [chunk[0] for chunk in chunks]
+
+    def test_wait(self):
+        recv_end1, send_end1 = self.shm_pipe(1000)
+        recv_end2, send_end2 = self.shm_pipe(1000)
+        send_end2.send(['foo'])
+        ready = multiprocessing.connection.wait([recv_end1, recv_end2], 1)
+        assert ready == [recv_end2]
+        assert recv_end2.recv() == ['foo']
+
+    def prepare_performance_test(self):
+        flag = os.environ.get('TEST_PERFORMANCE', 'no').lower()
+        test_requested = flag in ('yes', 'true', '1')
+        if not test_requested:
+            self.skipTest("Performance test not requested")
+
+    def transport_performance(self, recv_end, send_end, chunks, n):
+        def consume():
+            count = 0
+            while count < n * len(chunks[0]) * len(chunks):
+                count += len(recv_end.recv())
+            result_send.send(count)
+
+        result_recv, result_send = multiprocessing.Pipe(duplex=False)
+        consumer = multiprocessing.Process(target=consume, daemon=True)
+        consumer.start()
+        start_time = time.perf_counter()
+        for i in range(n):
+            for chunk in chunks:
+                send_end.send(chunk)
+        count = result_recv.recv()
+        t = time.perf_counter() - start_time
+        consumer.join()
+        return count / t
+
+    def test_transport_performance(self):
+        self.prepare_performance_test()
+        chunks = [rand_chunk(300) for i in range(10)]
+        recv_end, send_end = multiprocessing.Pipe(duplex=False)
+        pipe_rate = self.transport_performance(recv_end, send_end, chunks, 100)
+        recv_end, send_end = self.shm_pipe(8 * 1024 * 1024)
+        shm_rate = self.transport_performance(recv_end, send_end, chunks, 100)
+        print("\nipc throughput, pipe: %d metrics/s, shm: %d metrics/s" % (pipe_rate, shm_rate))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,18 +1,23 @@
 
 
+import os
 import json
+import zlib
+import socket
 import datetime
+import tempfile
 import string
 import random
 import unittest
 import itertools
 from unittest.mock import patch, MagicMock
+import bucky3.ipc as ipc
 import bucky3.jsond as jsond
 import time
 
 
 def jsond_verify(output_pipe, expected_values):
-    found_values = sum((i[0][0] for i in output_pipe.send.call_args_list), [])
+    found_values = sum((ipc.decode(i[0][0]) for i in output_pipe.send_bytes.call_args_list), [])
     for v in found_values:
         if v in expected_values:
             expected_values.remove(v)
@@ -115,6 +120,72 @@ class TestJsonDServer(unittest.TestCase):
             module.tick()
             jsond_verify(pipe, [])
 
+    @jsond_setup(timestamps=(2, 4, 6, 8, 10, 12, 14, 16, 20), chunk_size=3, eager_flush=True)
+    def test_eager_flush(self, module):
+        pipe = module.dst_pipes[0]
+        objs = [self.randdict() for i in range(4)]
+        module.handle_packet('\n'.join(json.dumps(obj) for obj in objs[:2]).encode('utf-8'))
+        jsond_verify(pipe, [])
+        # Full chunks go out right away, the rest waits for the tick
+        module.handle_packet('\n'.join(json.dumps(obj) for obj in objs[2:]).encode('utf-8'))
+        assert pipe.send_bytes.call_count == 1
+        jsond_verify(pipe, list(('metrics', obj, timestamp, {}) for obj, timestamp in zip(objs[:3], (2, 2, 4))))
+        module.tick()
+        jsond_verify(pipe, [('metrics', objs[3], 4, {})])
+
+    @jsond_setup(timestamps=(2, 4, 6, 8, 10, 12, 14, 16, 20), eager_flush=True)
+    def test_eager_flush_bytes(self, module):
+        pipe = module.dst_pipes[0]
+        objs = [self.randdict() for i in range(2)]
+        module.eager_flush_bytes = len(json.dumps(objs[0])) + 1
+        module.handle_packet(json.dumps(objs[0]).encode('utf-8'))
+        jsond_verify(pipe, [])
+        module.handle_packet(json.dumps(objs[1]).encode('utf-8'))
+        jsond_verify(pipe, list(('metrics', obj, timestamp, {}) for obj, timestamp in zip(objs, (2, 4))))
+        assert module.buffer_bytes == 0
+
+    @jsond_setup(timestamps=(2, 4, 6, 8, 10, 12, 14, 16, 20), chunk_size=2, eager_flush=True)
+    def test_eager_flush_leftover_bytes(self, module):
+        pipe = module.dst_pipes[0]
+        objs = [self.randdict() for i in range(4)]
+        data = ['\n'.join(json.dumps(obj) for obj in objs[:3]).encode('utf-8'), json.dumps(objs[3]).encode('utf-8')]
+        module.eager_flush_bytes = len(data[0]) + len(data[1])
+        module.handle_packet(data[0])
+        # A full chunk went out, the input behind the entry left over still counts
+        jsond_verify(pipe, list(('metrics', obj, 2, {}) for obj in objs[:2]))
+        assert module.buffer_bytes == len(data[0]) - len(data[0]) * 2 // 3
+        module.eager_flush_bytes = module.buffer_bytes + len(data[1])
+        module.handle_packet(data[1])
+        jsond_verify(pipe, list(('metrics', obj, timestamp, {}) for obj, timestamp in zip(objs[2:], (2, 4))))
+
+    @jsond_setup(timestamps=(2, 4, 6, 8, 10, 12, 14, 16, 20), local_host=None, socket_timeout=1,
+                 unix_socket_permissions=0o600)
+    def test_unix_dgram_socket(self, module):
+        pipe = module.dst_pipes[0]
+        objs = [self.randdict(), self.randdict(), self.randdict()]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            module.cfg['unix_dgram_path'] = os.path.join(tmp_dir, 'jsond.sock')
+            module.init_recv()
+            assert module.sock is None
+            assert os.stat(module.cfg['unix_dgram_path']).st_mode & 0o777 == 0o600
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            try:
+                client.sendto(json.dumps(objs[0]).encode('utf-8'), module.cfg['unix_dgram_path'])
+                client.sendto(zlib.compress(json.dumps(objs[1]).encode('utf-8')), module.cfg['unix_dgram_path'])
+                client.sendto(json.dumps(objs[2]).encode('utf-8'), module.cfg['unix_dgram_path'])
+                batch = []
+                while len(batch) < 3:
+                    batch.extend(module.recv_batch())
+            finally:
+                client.close()
+                module.close_unix_socket()
+        for data in batch:
+            module.handle_datagram(data)
+        assert module.datagrams_received == 3
+        assert module.bytes_received == sum(len(data) for data in batch)
+        module.tick()
+        jsond_verify(pipe, list(('metrics', obj, timestamp, {}) for obj, timestamp in zip(objs, (2, 4, 6))))
+
     @jsond_setup(timestamps=(2, 4, 6, 8, 10, 12, 14, 16, 18, 20))
     def test_malformed_lines(self, module):
         pipe = module.dst_pipes[0]
@@ -132,6 +203,7 @@ class TestJsonDServer(unittest.TestCase):
         module.handle_line(0, payload_str)
         module.tick()
         jsond_verify(pipe, [])
+        assert module.parse_errors == 3
 
     @jsond_setup(timestamps=(2, 4, 6, 8, 10, 12, 14, 16, 18, 20))
     def test_nested_objects(self, module):
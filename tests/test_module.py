@@ -0,0 +1,311 @@
+
+
+import os
+import time
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+import bucky3.ipc as ipc
+import bucky3.spill as spill
+import bucky3.module as module
+
+
+class BlockingPipe:
+    def __init__(self):
+        self.unblocked = threading.Event()
+        self.received = []
+
+    def send_bytes(self, data):
+        self.unblocked.wait()
+        self.received.append(data)
+
+
+class TestDestinationQueue(unittest.TestCase):
+    def start(self, dst_queue):
+        thread = threading.Thread(target=dst_queue.send_loop, daemon=True)
+        thread.start()
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+
+    def test_drop_oldest(self):
+        dst_queue = module.DestinationQueue('foo', None, 100, 'drop_oldest')
+        chunks = [bytes([i]) * 30 for i in range(10)]
+        for chunk in chunks:
+            dst_queue.put(chunk)
+        assert [data for timestamp, data in dst_queue.queue] == chunks[-3:]
+        assert dst_queue.queue_size == 90
+        assert dst_queue.chunks_dropped == 7
+
+    def test_drop_newest(self):
+        dst_queue = module.DestinationQueue('foo', None, 100, 'drop_newest')
+        chunks = [bytes([i]) * 30 for i in range(10)]
+        for chunk in chunks:
+            dst_queue.put(chunk)
+        assert [data for timestamp, data in dst_queue.queue] == chunks[:3]
+        assert dst_queue.chunks_dropped == 7
+
+    def test_interned_definitions(self):
+        # Dropped chunks leave their definitions behind, so the rest can still be decoded
+        encoder, decoder = ipc.Encoder(), ipc.Decoder()
+        pipe = BlockingPipe()
+        dst_queue = module.DestinationQueue('foo', pipe, 300, 'drop_oldest')
+        chunks = [[('foo', {'value': i}, None, {'name': str(i), 'pad': 'x' * 100})] for i in range(10)]
+        for chunk in chunks:
+            dst_queue.put(encoder.encode(chunk))
+        assert dst_queue.chunks_dropped > 0
+        pipe.unblocked.set()
+        self.start(dst_queue)
+        self.wait_for(lambda: not dst_queue.queue)
+        received = sum((ipc.decode(data, decoder) for data in pipe.received), [])
+        assert received == sum(chunks[-len(received):], [])
+        assert decoder.dropped == 0
+
+    def test_spill(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pipe = BlockingPipe()
+            spill_queue = spill.SpillQueue(os.path.join(tmp_dir, 'foo'), 10000)
+            dst_queue = module.DestinationQueue('foo', pipe, 100, 'spill', spill_queue)
+            chunks = [bytes([i]) * 30 for i in range(10)]
+            for chunk in chunks:
+                dst_queue.put(chunk)
+            assert dst_queue.chunks_spilled == 7 and dst_queue.chunks_dropped == 0
+            stats = dst_queue.stats()
+            assert stats['queue_chunks'] == 3 and stats['spill_chunks'] == 7
+            self.start(dst_queue)
+            pipe.unblocked.set()
+            self.wait_for(lambda: len(pipe.received) == 10)
+            assert pipe.received == chunks
+            assert dst_queue.stats()['lag'] == 0
+            spill_queue.close()
+
+    def test_no_stall(self):
+        slow_pipe, fast_pipe = BlockingPipe(), BlockingPipe()
+        fast_pipe.unblocked.set()
+        slow_queue = module.DestinationQueue('slow', slow_pipe, 100, 'drop_oldest')
+        fast_queue = module.DestinationQueue('fast', fast_pipe, 1000, 'drop_oldest')
+        self.start(slow_queue)
+        self.start(fast_queue)
+        for i in range(100):
+            slow_queue.put(b'foo')
+            fast_queue.put(b'foo')
+        self.wait_for(lambda: len(fast_pipe.received) == 100)
+        assert not slow_pipe.received
+        stats = slow_queue.stats()
+        # One chunk at most is stuck in the slow send, the rest is queued within the limit or dropped
+        assert stats['queue_size'] <= 100 and stats['queue_chunks'] + stats['chunks_dropped'] >= 99
+        slow_pipe.unblocked.set()
+
+
+class ListPush(module.MetricsPushProcess):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.down = False
+        self.pushed = []
+
+    def process_values(self, recv_timestamp, bucket, values, timestamp, metadata):
+        self.buffer_output(bucket)
+
+    def push_chunk(self, chunk):
+        if self.down:
+            raise ConnectionError("Down")
+        self.pushed.extend(chunk)
+        return []
+
+
+class TestPushSpill(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def push_setup(self, **extra_cfg):
+        cfg = dict(flush_interval=1, log_level='CRITICAL', buffer_limit=100, chunk_size=10, push_time_limit=10)
+        cfg.update(extra_cfg)
+        push_module = ListPush('push_test', cfg, None)
+        push_module.init_cfg()
+        push_module.down = True
+        for i in range(1000):
+            push_module.process_values(None, str(i), None, None, None)
+            if i % 10 == 9:
+                assert not push_module.flush(None)
+                push_module.trim_buffer()
+        push_module.down = False
+        return push_module
+
+    def test_trim(self):
+        push_module = self.push_setup()
+        assert push_module.flush(None)
+        assert push_module.pushed == [str(i) for i in range(900, 1000)]
+        assert push_module.metrics_dropped == 900
+
+    def test_replay(self):
+        push_module = self.push_setup(buffer_policy='spill', spill_path=self.tmp_dir.name, spill_replay_rate=100)
+        assert push_module.metrics_spilled == 900 and push_module.metrics_dropped == 0
+        assert push_module.flush(None)
+        # The buffer first, then the backlog from disk, up to the replay rate
+        assert push_module.pushed == [str(i) for i in range(900, 1000)] + [str(i) for i in range(100)]
+        push_module.spill_replay_rate = push_module.spill_replay_allowance = 10000
+        push_module.process_values(None, 'foo', None, None, None)
+        assert push_module.flush(None)
+        assert push_module.pushed[200:] == ['foo'] + [str(i) for i in range(100, 900)]
+        report = push_module.produce_self_report()
+        assert report['metrics_sent'] == 1001 and report['spill_chunks'] == 0
+
+
+class TestPushBuffer(unittest.TestCase):
+    def push_setup(self, **extra_cfg):
+        cfg = dict(flush_interval=1, log_level='CRITICAL', chunk_size=10, push_time_limit=10)
+        cfg.update(extra_cfg)
+        push_module = ListPush('push_test', cfg, None)
+        push_module.init_cfg()
+        return push_module
+
+    def test_accounting(self):
+        push_module = self.push_setup(buffer_limit=1000, buffer_size_limit=1000)
+        for i in range(100):
+            push_module.buffer_output('%04d' % i)
+        assert push_module.buffer_size() == 400
+        push_module.down = True
+        assert not push_module.flush(None)
+        assert len(push_module.buffer) == 100 and push_module.buffer_size() == 400
+        for i in range(100, 300):
+            push_module.buffer_output('%04d' % i)
+        # Over the size limit, trimmed to half of it
+        push_module.trim_buffer()
+        assert push_module.buffer_size() == 500
+        assert list(push_module.buffer) == ['%04d' % i for i in range(175, 300)]
+        push_module.down = False
+        assert push_module.flush(None)
+        assert push_module.pushed == ['%04d' % i for i in range(175, 300)]
+        assert push_module.buffer_size() == 0 and push_module.metrics_dropped == 175
+
+    def test_size_limit(self):
+        # Within buffer_limit, only the size limit applies
+        push_module = self.push_setup(buffer_limit=100, buffer_size_limit=200)
+        for i in range(80):
+            push_module.buffer_output('%04d' % i)
+        push_module.trim_buffer()
+        assert list(push_module.buffer) == ['%04d' % i for i in range(55, 80)]
+        assert push_module.buffer_size() == 100 and push_module.metrics_dropped == 55
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def start_push_thread(self, push_module):
+        push_module.start_thread('PushThread', push_module.push_loop)
+
+        def stop():
+            # Other tests mock time, the thread must be parked before they run
+            parked = threading.Event()
+            push_module.push = lambda: (parked.set(), threading.Event().wait())
+            push_module.push_event.set()
+            parked.wait(5)
+
+        self.addCleanup(stop)
+
+    def test_push_thread(self):
+        push_module = self.push_setup(max_push_latency=10)
+        self.start_push_thread(push_module)
+        # Full chunks go out right away
+        for i in range(10):
+            push_module.buffer_output(str(i))
+        assert self.wait_for(lambda: push_module.pushed == [str(i) for i in range(10)])
+        for i in range(5):
+            push_module.buffer_output(str(i))
+        assert not self.wait_for(lambda: len(push_module.pushed) > 10, 0.2)
+        # Until the deadline, which takes care of the rest
+        push_module = self.push_setup(max_push_latency=0.05)
+        self.start_push_thread(push_module)
+        push_module.buffer_output('foo')
+        assert self.wait_for(lambda: push_module.pushed == ['foo'])
+        # The main loop leaves it to the push thread
+        push_module = self.push_setup(max_push_latency=10)
+        push_module.buffer_output('foo')
+        push_module.tick()
+        assert not push_module.pushed
+
+    def test_drain_performance(self):
+        flag = os.environ.get('TEST_PERFORMANCE', 'no').lower()
+        if flag not in ('yes', 'true', '1'):
+            self.skipTest("Performance test not requested")
+        push_module = self.push_setup(buffer_limit=1000000, push_count_limit=1000000, chunk_size=300)
+        for i in range(1000000):
+            push_module.buffer_output('foo.bar %d 1234567890\n' % i)
+        start_time = time.perf_counter()
+        assert push_module.flush(None)
+        t = time.perf_counter() - start_time
+        assert len(push_module.pushed) == 1000000
+        print("\npush buffer drain, %d entries/s" % (1000000 / t))
+
+
+class TestScheduler(unittest.TestCase):
+    def test_jobs(self):
+        clock, runs = [0], []
+        with patch('time.monotonic', lambda: clock[0]):
+            scheduler = module.Scheduler()
+            scheduler.add_job('foo', lambda: runs.append(('foo', clock[0])), 10)
+            scheduler.add_job('bar', lambda: runs.append(('bar', clock[0])) or 7, 5, delay=1)
+            assert scheduler.timeout() == 0
+            for t in (0, 1, 8, 9.5, 10.2, 15, 16, 20, 30.5):
+                clock[0] = t
+                scheduler.run_pending()
+            # Late wakeups don't shift the schedule, foo stays on multiples of 10
+            assert runs == [
+                ('foo', 0), ('bar', 1), ('bar', 8), ('foo', 10.2), ('bar', 15), ('foo', 20), ('bar', 30.5), ('foo', 30.5)
+            ]
+            assert scheduler.timeout() == 37.5 - 30.5
+            assert scheduler.take_jitter() == 30.5 - 22
+            assert scheduler.take_jitter() == 0
+            clock[0] = 100
+            runs.clear()
+            scheduler.run_pending()
+            # Overdue by more than an interval, both start over from now
+            assert runs == [('bar', 100), ('foo', 100)]
+            assert scheduler.timeout() == 7
+
+    def test_failing_job(self):
+        clock, runs = [0], []
+
+        def fail():
+            runs.append(clock[0])
+            raise InterruptedError()
+
+        with patch('time.monotonic', lambda: clock[0]):
+            scheduler = module.Scheduler()
+            scheduler.add_job('foo', fail, 10)
+            for t in (0, 10):
+                clock[0] = t
+                with self.assertRaises(InterruptedError):
+                    scheduler.run_pending()
+            # Still scheduled after raising
+            assert runs == [0, 10]
+            assert scheduler.timeout() == 10
+
+    def test_aligned_jobs(self):
+        # Wall clock is ahead of monotonic time and they drift apart
+        clock, wall_offset, runs = [0], [1003.5], []
+        with patch('time.monotonic', lambda: clock[0]), patch('time.time', lambda: clock[0] + wall_offset[0]):
+            scheduler = module.Scheduler()
+            scheduler.add_job('foo', lambda: runs.append(clock[0] + wall_offset[0]), 10, delay=2, align=10)
+            assert scheduler.timeout() == 1012 - 1003.5
+            for t in (8.5, 18.6, 28.4):
+                clock[0] = t
+                scheduler.run_pending()
+                wall_offset[0] += 0.1
+            assert [round(t, 3) for t in runs] == [1012, 1022.2, 1032.1]
+            # Due on the next multiple past the offset, by wall clock
+            assert round(scheduler.timeout(), 3) == round(1042 - 1032.1, 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+
+
+import math
+import random
+import unittest
+import bucky3.sketch as sketch
+
+
+class TestDDSketch(unittest.TestCase):
+    def rand_vec(self, length):
+        return [random.lognormvariate(3, 1) for i in range(length)]
+
+    def exact_prefix(self, values, rank):
+        prefix = sorted(values)[:rank]
+        return len(prefix), sum(prefix), sum(x * x for x in prefix), prefix[-1]
+
+    def assert_close(self, expected, found, tolerance):
+        assert math.isclose(expected, found, rel_tol=tolerance), str(found) + " is not close to " + str(expected)
+
+    def test_percentiles(self):
+        values = self.rand_vec(10000)
+        s = sketch.DDSketch(0.01)
+        for v in values:
+            s.append(v)
+        assert len(s) == 10000
+        assert s.min == min(values) and s.max == max(values)
+        ranks = [100, 5000, 9000, 9900, 10000]
+        for rank, (vlen, vsum, vsum_squares, upper) in zip(ranks, s.prefixes(ranks)):
+            exact_vlen, exact_vsum, exact_vsum_squares, exact_upper = self.exact_prefix(values, rank)
+            assert vlen == exact_vlen
+            self.assert_close(exact_upper, upper, 0.01)
+            self.assert_close(exact_vsum, vsum, 0.01)
+            self.assert_close(exact_vsum_squares, vsum_squares, 0.02)
+
+    def test_negative_and_zero_values(self):
+        s = sketch.DDSketch(0.01)
+        for v in (-10, -1, 0, 0, 1, 10):
+            s.append(v)
+        prefixes = list(s.prefixes([1, 3, 4, 6]))
+        self.assert_close(-10, prefixes[0][3], 0.01)
+        assert prefixes[1][3] == 0
+        assert prefixes[2][3] == 0
+        assert prefixes[3][3] == 10
+        assert prefixes[3][0] == 6
+        self.assert_close(0, prefixes[3][1], 0.01)
+
+    def test_merge(self):
+        values1, values2 = self.rand_vec(1000), self.rand_vec(3000)
+        s1, s2, s3 = sketch.DDSketch(0.02), sketch.DDSketch(0.02), sketch.DDSketch(0.02)
+        for v in values1:
+            s1.append(v)
+            s3.append(v)
+        for v in values2:
+            s2.append(v)
+            s3.append(v)
+        s1.merge(s2)
+        assert s1.count == s3.count and s1.min == s3.min and s1.max == s3.max
+        ranks = [400, 2000, 3600, 4000]
+        for merged, combined in zip(s1.prefixes(ranks), s3.prefixes(ranks)):
+            assert merged[0] == combined[0]
+            assert merged[3] == combined[3]
+            self.assert_close(combined[1], merged[1], 1e-9)
+        with self.assertRaises(ValueError):
+            s1.merge(sketch.DDSketch(0.01))
+
+    def test_bounded_memory(self):
+        s = sketch.DDSketch(0.01, max_bins=50)
+        for i in range(1, 100000):
+            s.append(i)
+        assert len(s.positive) <= 50
+        # Upper percentiles stay accurate, only the lowest bins are collapsed.
+        vlen, vsum, vsum_squares, upper = next(s.prefixes([99000]))
+        self.assert_close(99000, upper, 0.01)
+        s = sketch.DDSketch(0.01, max_bins=50)
+        for i in range(1, 100000):
+            s.append(-i)
+        assert len(s.negative) <= 50
+        # Same with negative values, the ones closest to zero are the upper percentiles.
+        vlen, vsum, vsum_squares, upper = next(s.prefixes([99990]))
+        self.assert_close(-10, upper, 0.01)
+
+    def test_non_finite_values(self):
+        s = sketch.DDSketch()
+        for v in (float('inf'), float('-inf'), float('nan')):
+            with self.assertRaises(ValueError):
+                s.append(v)
+        assert s.count == 0
+
+
+class TestHyperLogLog(unittest.TestCase):
+    def test_cardinality(self):
+        for precision in (10, 12, 14):
+            error = 1.04 / math.sqrt(2 ** precision)
+            for cardinality in (1, 10, 100, 1000, 100000):
+                hll = sketch.HyperLogLog(precision)
+                for i in range(cardinality):
+                    hll.add(str(i))
+                    hll.add(str(i))
+                assert abs(len(hll) - cardinality) <= 4 * error * cardinality + 1
+
+    def test_bounded_memory(self):
+        hll = sketch.HyperLogLog(8, (str(i) for i in range(100000)))
+        assert len(hll.registers) == 256
+
+    def test_merge(self):
+        hll1 = sketch.HyperLogLog(12, (str(i) for i in range(0, 30000)))
+        hll2 = sketch.HyperLogLog(12, (str(i) for i in range(20000, 50000)))
+        hll3 = sketch.HyperLogLog(12, (str(i) for i in range(0, 50000)))
+        hll1.update(hll2)
+        assert hll1.registers == hll3.registers
+        with self.assertRaises(ValueError):
+            hll1.update(sketch.HyperLogLog(10))
+        with self.assertRaises(ValueError):
+            sketch.HyperLogLog(20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+
+
+import os
+import tempfile
+import unittest
+import bucky3.spill as spill
+
+
+class TestSpillQueue(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'queue')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def drain(self, queue):
+        records = []
+        while True:
+            record = queue.peek()
+            if record is None:
+                return records
+            records.append(record[1])
+            queue.pop()
+
+    def test_order(self):
+        queue = spill.SpillQueue(self.path, 10000, segment_size=100)
+        records = [str(i).encode() * (i % 20 + 1) for i in range(100)]
+        for record in records:
+            assert queue.append(record)
+        assert queue.records == 100
+        assert len(os.listdir(self.path)) > 2
+        for i in range(30):
+            assert queue.peek()[1] == records[i]
+            queue.pop()
+        queue.close()
+        # Picks up where it left off, consumed segments are gone
+        queue = spill.SpillQueue(self.path, 10000, segment_size=100)
+        assert queue.records == 70
+        assert self.drain(queue) == records[30:]
+        assert queue.size == 0
+        assert os.listdir(self.path) == ['head']
+        queue.append(b'foo')
+        assert self.drain(queue) == [b'foo']
+
+    def test_max_size(self):
+        queue = spill.SpillQueue(self.path, 1000, segment_size=200)
+        records = [b'%03d' % i * 10 for i in range(100)]
+        for record in records:
+            assert queue.append(record)
+        assert queue.size <= 1000
+        # The oldest segments were dropped
+        assert queue.records_dropped + queue.records == 100
+        remaining = self.drain(queue)
+        assert remaining == records[-len(remaining):]
+        assert not queue.append(b'x' * 1000)
+
+    def test_truncated_record(self):
+        queue = spill.SpillQueue(self.path, 1000)
+        queue.append(b'foo')
+        queue.append(b'bar')
+        queue.close()
+        segment = [f for f in os.listdir(self.path) if f.endswith('.seg')][0]
+        with open(os.path.join(self.path, segment), 'ab') as f:
+            f.write(b'\x10\x00\x00')
+        queue = spill.SpillQueue(self.path, 1000)
+        assert queue.records == 2
+        queue.append(b'baz')
+        assert self.drain(queue) == [b'foo', b'bar', b'baz']
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,6 +3,11 @@
 import os
 import io
 import sys
+import array
+import functools
+import socket
+import tempfile
+import threading
 import time
 import string
 import random
@@ -12,6 +17,7 @@ import cProfile
 import itertools
 import statistics
 from unittest.mock import patch, MagicMock
+import bucky3.ipc as ipc
 import bucky3.statsd as statsd
 
 
@@ -23,7 +29,7 @@ class RoughFloat(float):
 
 
 def statsd_verify(output_pipe, expected_values):
-    found_values = sum((i[0][0] for i in output_pipe.send.call_args_list), [])
+    found_values = sum((ipc.decode(i[0][0]) for i in output_pipe.send_bytes.call_args_list), [])
     for v in found_values:
         if v in expected_values:
             expected_values.remove(v)
@@ -127,7 +133,7 @@ class TestStatsDServer(unittest.TestCase):
             statsd_module.handle_packet(s.encode("utf-8"))
             statsd_module.tick()
             assert not mock_pipe.called
-            assert not mock_pipe.send.called
+            assert not mock_pipe.send_bytes.called
             mock_pipe.reset_mock()
 
         test(":1|" + entry_type)
@@ -166,7 +172,7 @@ class TestStatsDServer(unittest.TestCase):
             statsd_module.handle_line(i, entry + '|#' + name + '=' + value)
             statsd_module.tick()
             assert not mock_pipe.called
-            assert not mock_pipe.send.called
+            assert not mock_pipe.send_bytes.called
             mock_pipe.reset_mock()
             i += 1
 
@@ -175,7 +181,7 @@ class TestStatsDServer(unittest.TestCase):
             statsd_module.handle_line(i, entry + '|#' + name + '=' + value)
             statsd_module.tick()
             assert not mock_pipe.called
-            assert not mock_pipe.send.called
+            assert not mock_pipe.send_bytes.called
             mock_pipe.reset_mock()
             i += 1
 
@@ -186,7 +192,7 @@ class TestStatsDServer(unittest.TestCase):
             statsd_module.handle_packet((entry + "|#timestamp=" + s).encode("ascii"))
             statsd_module.tick()
             assert not mock_pipe.called
-            assert mock_pipe.send.called == condition
+            assert mock_pipe.send_bytes.called == condition
             mock_pipe.reset_mock()
 
         test(False, "")
@@ -203,11 +209,11 @@ class TestStatsDServer(unittest.TestCase):
             statsd_module.handle_packet((entry + "|#hello=world,bucket=" + s).encode("ascii"))
             statsd_module.tick()
             assert not mock_pipe.called
-            assert mock_pipe.send.called == condition
+            assert mock_pipe.send_bytes.called == condition
             if condition:
-                args, kwargs = mock_pipe.send.call_args
+                args, kwargs = mock_pipe.send_bytes.call_args
                 assert len(args) == 1
-                payload = args[0]
+                payload = ipc.decode(args[0])
                 assert len(payload) == 1
                 payload = payload[0]
                 assert payload[0] == s
@@ -373,6 +379,145 @@ class TestStatsDServer(unittest.TestCase):
         statsd_module.tick()
         statsd_verify(mock_pipe, [])
 
+    @statsd_setup(timestamps=range(1, 100), set_engine='hll', set_hll_threshold=10)
+    def test_sets_hll(self, statsd_module):
+        mock_pipe = statsd_module.dst_pipes[0]
+        for i in range(5000):
+            statsd_module.handle_line(0, "gorm:" + str(i % 2000) + "|s")
+        for i in range(10):
+            statsd_module.handle_line(0, "gurm:" + str(i) + "|s")
+        assert isinstance(statsd_module.sets[(('name', 'gorm'),)][1], statsd.sketch.HyperLogLog)
+        assert isinstance(statsd_module.sets[(('name', 'gurm'),)][1], set)
+        statsd_module.tick()
+        found_values = {
+            metadata['name']: stats['count']
+            for bucket, stats, timestamp, metadata in sum((ipc.decode(i[0][0]) for i in mock_pipe.send_bytes.call_args_list), [])
+        }
+        assert abs(found_values['gorm'] - 2000) <= 0.1 * 2000
+        assert found_values['gurm'] == 10
+
+    @statsd_setup(timestamps=range(1, 100), set_engine='hll', set_hll_threshold=10)
+    def test_sets_hll_merge(self, statsd_module):
+        dst = {}
+        hll = statsd.sketch.HyperLogLog(12, (str(i) for i in range(100)))
+        statsd_module.merge_sets(dst, {'a': (None, {'x', 'y'}), 'b': (None, {'x'})})
+        statsd_module.merge_sets(dst, {'a': (None, {str(i) for i in range(9)}), 'b': (None, hll)})
+        assert isinstance(dst['a'][1], statsd.sketch.HyperLogLog) and abs(len(dst['a'][1]) - 11) <= 1
+        assert isinstance(dst['b'][1], statsd.sketch.HyperLogLog) and abs(len(dst['b'][1]) - 101) <= 5
+
+    @statsd_setup(timestamps=range(1, 100), cardinality_limit=2, cardinality_limit_total=3)
+    def test_cardinality_limit(self, statsd_module):
+        mock_pipe = statsd_module.dst_pipes[0]
+        for i in range(4):
+            statsd_module.handle_line(0, "gorm:1|c|#request=" + str(i))
+            statsd_module.handle_line(0, "gorm:1|c|#request=" + str(i) + ",bucket=custom")
+        statsd_module.handle_line(0, "gurm:1|c|#a=b")
+        statsd_module.handle_line(0, "gurm:1|c|#a=c")
+        statsd_module.handle_line(0, "blah:1|c")
+        statsd_module.handle_line(0, "gorm:1|c|#request=0")
+        statsd_module.tick()
+        statsd_verify(mock_pipe, [
+            ('stats_counters', dict(rate=2, count=2), 1, dict(name='gorm', request='0')),
+            ('custom', dict(rate=1, count=1), 1, dict(name='gorm', request='0')),
+            ('stats_counters', dict(rate=3, count=3), 1, dict(name='gorm', series='__overflow__')),
+            ('custom', dict(rate=3, count=3), 1, dict(name='gorm', series='__overflow__')),
+            ('stats_counters', dict(rate=1, count=1), 1, dict(name='gurm', a='b')),
+            ('stats_counters', dict(rate=1, count=1), 1, dict(name='gurm', series='__overflow__')),
+            ('stats_counters', dict(rate=1, count=1), 1, dict(name='__overflow__', series='__overflow__')),
+        ])
+        assert statsd_module.ingest_stats()['series_overflows'] == 8
+        details = list(statsd_module.produce_self_report_details())
+        assert details[0] == ({'overflow_name': 'gorm'}, {'series_overflows': 6})
+        assert len(details) == 3
+        # Budgets are renewed each flush
+        statsd_module.handle_line(1, "blah:1|c")
+        statsd_module.tick()
+        statsd_verify(mock_pipe, [
+            ('stats_counters', dict(rate=1, count=1), 2, dict(name='blah')),
+        ])
+        assert not list(statsd_module.produce_self_report_details())
+
+    @statsd_setup(timestamps=range(1, 100), cardinality_limit=50, cardinality_limit_total=100)
+    def test_cardinality_limit_threads(self, statsd_module):
+        # The UDP read thread and the stream listener share the budgets
+        def ingest(prefix):
+            for i in range(1000):
+                statsd_module.handle_line(0, prefix + str(i % 10) + ":1|c|#request=" + str(i))
+
+        threads = [threading.Thread(target=ingest, args=(prefix,)) for prefix in ('gorm', 'gurm', 'gorp', 'gurp')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert statsd_module.series_total == 100
+        assert sum(len(keys) for keys in statsd_module.series.values()) == 100
+        assert statsd_module.series_overflowed == 4000 - 100
+
+    @statsd_setup(timestamps=range(1, 100), load_shedding=True, percentile_thresholds=(100,))
+    def test_load_shedding(self, statsd_module):
+        mock_pipe = statsd_module.dst_pipes[0]
+        # Within the hysteresis band, the sampling stays as it is
+        statsd_module.measure_load = lambda: (0.6, 0)
+        statsd_module.adjust_sampling(1.0, 0)
+        statsd_module.adjust_sampling(0.1, 0.9)
+        assert statsd_module.sampling_factor == 4
+        for i in range(100):
+            statsd_module.handle_line(0, "gorm:1|c")
+            statsd_module.handle_line(0, "gorm:1|c|@0.5|#a=b")
+            statsd_module.handle_line(0, "gurm:5|ms")
+            statsd_module.handle_line(0, "gorp:" + str(i) + "|s")
+            statsd_module.handle_line(0, "blah:" + str(i) + "|g")
+        assert statsd_module.ingest_stats()['metrics_sampled_out'] == 300
+        statsd_module.tick()
+        statsd_verify(mock_pipe, [
+            ('stats_counters', dict(rate=100, count=100), 1, dict(name='gorm')),
+            ('stats_counters', dict(rate=200, count=200), 1, dict(name='gorm', a='b')),
+            ('stats_timers', dict(count=25, count_ps=25, lower=5, upper=5, mean=5, stdev=0), 1,
+             dict(name='gurm', percentile='100.0')),
+            ('stats_sets', dict(count=25), 1, dict(name='gorp')),
+            ('stats_gauges', dict(value=99), 1, dict(name='blah')),
+            ('bucky3', dict(sampling_ratio=0.25), 1, dict(name='statsd_test')),
+        ])
+        # Back to full fidelity, in two steps
+        statsd_module.measure_load = lambda: (0.1, 0)
+        statsd_module.tick()
+        assert statsd_module.sampling_factor == 2
+        statsd_module.tick()
+        assert statsd_module.sampling_factor == 1
+        mock_pipe.reset_mock()
+        statsd_module.handle_line(2, "gorm:1|c")
+        statsd_module.tick()
+        statsd_verify(mock_pipe, [
+            ('stats_counters', dict(rate=1, count=1), 4, dict(name='gorm')),
+            ('bucky3', dict(sampling_ratio=1.0), 4, dict(name='statsd_test')),
+        ])
+
+    @statsd_setup(timestamps=range(1, 100))
+    def test_sampling_phases(self, statsd_module):
+        # A series with one sample per interval is kept in about 1 in sampling_factor intervals
+        statsd_module.sampling_factor = 4
+        taken = 0
+        for i in range(1000):
+            taken += statsd_module.take_sample(('gorm', ()))
+            statsd_module.take_aggregates()
+        assert 150 < taken < 350
+
+    @statsd_setup(timestamps=range(1, 100))
+    def test_sampling_threads(self, statsd_module):
+        # The UDP read thread and the stream listener share the sampling phases
+        statsd_module.sampling_factor = 4
+        taken = []
+
+        def ingest():
+            taken.append(sum(statsd_module.take_sample(('gorm', ())) for i in range(10000)))
+
+        threads = [threading.Thread(target=ingest) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sum(taken) == 10000
+
     @statsd_setup(timestamps=range(1, 100))
     def test_sets_metadata(self, statsd_module):
         mock_pipe = statsd_module.dst_pipes[0]
@@ -525,6 +670,68 @@ class TestStatsDServer(unittest.TestCase):
                                     dict(name=test_name, percentile=str(float(threshold_v)))))
         statsd_verify(statsd_module.dst_pipes[0], expected_values)
 
+    @statsd_setup(timestamps=range(1, 100), percentile_thresholds=_percentile_thresholds, timer_engine='sketch')
+    def test_timer_sketch_large_series(self, statsd_module):
+        mock_pipe = statsd_module.dst_pipes[0]
+        test_vector = self.rand_vec(length=3000)
+        for sample in test_vector:
+            statsd_module.handle_line(0, "gorm:" + str(sample) + "|ms")
+        statsd_module.handle_line(0, "gurm:100|ms")
+        statsd_module.tick()
+        test_vector.sort()
+        found_values = {
+            metadata['name'] + '_' + metadata['percentile']: stats
+            for bucket, stats, timestamp, metadata in sum((ipc.decode(i[0][0]) for i in mock_pipe.send_bytes.call_args_list), [])
+        }
+        assert len(found_values) == 2 * len(self._percentile_thresholds)
+        for threshold_v in self._percentile_thresholds:
+            threshold_i = len(test_vector) if threshold_v == 100 else (threshold_v * len(test_vector)) // 100
+            threshold_slice = test_vector[:int(threshold_i)]
+            stats = found_values['gorm_' + str(float(threshold_v))]
+            assert stats['count'] == len(threshold_slice)
+            assert stats['lower'] == min(threshold_slice)
+            assert abs(stats['upper'] - max(threshold_slice)) <= 0.01 * max(threshold_slice)
+            assert abs(stats['mean'] - statistics.mean(threshold_slice)) <= 0.01 * statistics.mean(threshold_slice)
+            stats = found_values['gurm_' + str(float(threshold_v))]
+            assert stats == dict(count=1, count_ps=1, lower=100, upper=100, mean=100)
+
+    @statsd_setup(timestamps=range(1, 100), percentile_thresholds=_percentile_thresholds, timer_engine='numpy')
+    def test_timer_numpy_engine(self, statsd_module):
+        assert statsd_module.timer_engine == ('numpy' if statsd.numpy else 'sort')
+        if statsd.numpy is None:
+            self.skipTest("NumPy not available")
+        for length in (1, 2, 3, 10, 100, 3000):
+            test_vector = self.rand_vec(length=length)
+            expected_values = list(statsd_module.sort_percentiles(list(test_vector)))
+            found_values = list(statsd_module.numpy_percentiles(array.array('d', test_vector)))
+            assert len(found_values) == len(expected_values)
+            for (expected_t, expected), (found_t, found) in zip(expected_values, found_values):
+                assert found_t == expected_t
+                assert found[0] == expected[0]
+                assert found[3] == expected[3] and found[4] == expected[4]
+                assert abs(found[1] - expected[1]) <= 1e-9 * abs(expected[1])
+                assert abs(found[2] - expected[2]) <= 1e-9 * abs(expected[2])
+
+    @statsd_setup(timestamps=range(1, 100), percentile_thresholds=_percentile_thresholds, timer_engine='select')
+    def test_timer_select_engine(self, statsd_module):
+        for length in (1, 2, 3, 10, 100, 3000):
+            for test_vector in (self.rand_vec(length=length), [round(x) for x in self.rand_vec(length=length)]):
+                expected_values = list(statsd_module.sort_percentiles(list(test_vector)))
+                found_values = list(statsd_module.select_percentiles(list(test_vector)))
+                assert len(found_values) == len(expected_values)
+                for (expected_t, expected), (found_t, found) in zip(expected_values, found_values):
+                    assert found_t == expected_t
+                    assert found[0] == expected[0]
+                    assert found[3] == expected[3] and found[4] == expected[4]
+                    assert abs(found[1] - expected[1]) <= 1e-9 * abs(expected[1])
+                    assert abs(found[2] - expected[2]) <= 1e-9 * abs(expected[2])
+
+    @statsd_setup(timestamps=range(1, 100), timer_engine='select')
+    def test_timer_select_engine_no_thresholds(self, statsd_module):
+        for i in range(100):
+            statsd_module.handle_line(0, "gorm:%d|ms" % i)
+        return []
+
     @statsd_setup(timestamps=range(1, 100), percentile_thresholds=(100,))
     def test_timers_metadata(self, statsd_module):
         mock_pipe = statsd_module.dst_pipes[0]
@@ -647,6 +854,46 @@ class TestStatsDServer(unittest.TestCase):
         statsd_module.tick()
         statsd_verify(mock_pipe, expected_values)
 
+    @statsd_setup(flush_interval=0.1,
+                  timestamps=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7),
+                  histogram_bins=(({'name': 'gorm'}, (100,)), ({'name': 'gurm', 'a': 'b'}, (1000, 300))),
+                  histogram_selector=lambda key: lambda x: 'test_histogram')
+    def test_histogram_bins(self, statsd_module):
+        mock_pipe = statsd_module.dst_pipes[0]
+        selectors = dict(gorm=multiple_histogram_selector(dict(name='gorm')),
+                         gurm=multiple_histogram_selector(dict(name='gurm')))
+        test_samples = dict(gorm={}, gurm={}, foo={})
+        for i in range(3000):
+            name = random.choice(tuple(test_samples.keys()))
+            value = random.randint(0, 1500)
+            statsd_module.handle_line(0, name + ":" + str(value) + "|h|#a=b")
+            if name in selectors:
+                bucket = selectors[name](value)[len(name) + 1:]
+            else:
+                bucket = 'test_histogram'
+            test_samples[name].setdefault(bucket, []).append(value)
+        statsd_module.handle_line(0, "gurm:1|h")
+        expected_values = [
+            ('stats_histograms', dict(count=1, count_ps=10, lower=1, upper=1, mean=1), 0.1,
+             dict(name='gurm', histogram='test_histogram'))
+        ]
+        for name, d in test_samples.items():
+            for k, v in d.items():
+                expected_value = {
+                    "mean": RoughFloat(statistics.mean(v)),
+                    "lower": min(v),
+                    "upper": max(v),
+                    "count": len(v),
+                    "count_ps": RoughFloat(len(v) * 10),
+                }
+                if len(v) > 1:
+                    expected_value['stdev'] = RoughFloat(statistics.stdev(v))
+                expected_values.append(
+                    ('stats_histograms', expected_value, 0.1, dict(name=name, histogram=k, a='b'))
+                )
+        statsd_module.tick()
+        statsd_verify(mock_pipe, expected_values)
+
     @statsd_setup(timestamps=range(1, 1000))
     def test_malformed_histograms(self, statsd_module):
         self.malformed_entries(statsd_module, 'h')
@@ -676,6 +923,265 @@ class TestStatsDServer(unittest.TestCase):
             ('stats_counters', dict(rate=1, count=1), 1, dict(name='foo', hello='world', more='metadata')),
         ])
 
+    @statsd_setup(timestamps=range(1, 1000), key_cache_size=2)
+    def test_key_cache(self, statsd_module):
+        mock_pipe = statsd_module.dst_pipes[0]
+        statsd_module.handle_line(0, "foo:1|c|#hello=world")
+        statsd_module.handle_line(0, "foo:1|c|#hello=world")
+        statsd_module.handle_line(0, "foo:2|g|#hello=world")
+        statsd_module.handle_line(0, "bar:1|c")
+        statsd_module.handle_line(0, "bar:1|c|#hello=world")
+        statsd_module.handle_line(0, "foo:1|c|#hello=world")
+        statsd_module.handle_line(0, "foo:1|c|#hello=world,timestamp=1")
+        statsd_module.handle_line(0, "foo:1|c|#hello=world,timestamp=1000")  # Beyond 10min window
+        statsd_module.handle_line(0, "foo:1|c|#hello=,")
+        statsd_module.handle_line(0, "foo:1|c|#hello=,")
+        stats = statsd_module.ingest_stats()
+        # Malformed lines never get cached, evicted entries get parsed again
+        assert stats['key_cache_hits'] == 2
+        assert stats['key_cache_misses'] == 6
+        statsd_module.tick()
+        statsd_verify(mock_pipe, [
+            ('stats_counters', dict(rate=4, count=4), 1, dict(name='foo', hello='world')),
+            ('stats_gauges', dict(value=2), 1, dict(name='foo', hello='world')),
+            ('stats_counters', dict(rate=1, count=1), 1, dict(name='bar')),
+            ('stats_counters', dict(rate=1, count=1), 1, dict(name='bar', hello='world')),
+        ])
+
+    @statsd_setup(timestamps=range(1, 1000), local_host='127.0.0.1:0', socket_timeout=1, recv_batch_size=2)
+    def test_batched_recv(self, statsd_module):
+        mock_pipe = statsd_module.dst_pipes[0]
+        statsd_module.init_recv()
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for datagram in (b"gorm:1|c", b"gorm:2|c\ngurm:1|c", b"gurm:\xff|c", b"gurm:3|c"):
+                client.sendto(datagram, statsd_module.sock.getsockname())
+            recv_stats = statsd_module.recv_stats()
+            if sys.platform.startswith('linux'):
+                # Loopback datagrams are queued up by the time sendto returns
+                assert recv_stats['recv_queue_bytes'] > 0
+            batches = []
+            while sum(len(batch) for batch in batches) < 4:
+                batch = statsd_module.recv_batch()
+                assert 0 < len(batch) <= 2
+                batches.append(batch)
+        finally:
+            client.close()
+            statsd_module.close_socket()
+        # Two batches, the second one with a malformed datagram in it, so it gets handled one by one.
+        for batch in batches:
+            statsd_module.handle_datagrams(batch)
+        assert statsd_module.datagrams_received == 4
+        assert statsd_module.datagrams_dropped == 0
+        assert statsd_module.bytes_received == 41
+        assert statsd_module.parse_errors == 1
+        statsd_module.last_timestamp = 0
+        statsd_module.tick()
+        system_timestamp = statsd_module.last_timestamp
+        statsd_verify(mock_pipe, [
+            ('stats_counters', dict(rate=3 / system_timestamp, count=3), system_timestamp, dict(name='gorm')),
+            ('stats_counters', dict(rate=4 / system_timestamp, count=4), system_timestamp, dict(name='gurm')),
+        ])
+
+    @statsd_setup(timestamps=range(1, 1000), local_host='127.0.0.1:0', socket_timeout=1)
+    def test_unix_dgram_socket(self, statsd_module):
+        mock_pipe = statsd_module.dst_pipes[0]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            unix_dgram_path = os.path.join(tmp_dir, 'statsd.sock')
+            statsd_module.cfg['unix_dgram_path'] = unix_dgram_path
+            statsd_module.init_recv()
+            udp_client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            unix_client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            try:
+                udp_client.sendto(b"gorm:1|c", statsd_module.sock.getsockname())
+                # Too big for the receive buffer, dropped rather than parsed cut short
+                unix_client.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 256 * 1024)
+                unix_client.sendto(b"gorm:1|c\n" * 8000 + b"gorm:123456|c", unix_dgram_path)
+                unix_client.sendto(b"gorm:2|c\ngurm:1|c", unix_dgram_path)
+                batch = []
+                while len(batch) < 2:
+                    batch.extend(statsd_module.recv_batch())
+                assert statsd_module.datagrams_truncated == 1
+            finally:
+                udp_client.close()
+                unix_client.close()
+                statsd_module.close_socket()
+                statsd_module.close_unix_socket()
+                statsd_module.remove_unix_socket_files()
+            assert not os.path.exists(unix_dgram_path)
+        statsd_module.handle_datagrams(batch)
+        statsd_module.last_timestamp = 0
+        statsd_module.tick()
+        system_timestamp = statsd_module.last_timestamp
+        statsd_verify(mock_pipe, [
+            ('stats_counters', dict(rate=3 / system_timestamp, count=3), system_timestamp, dict(name='gorm')),
+            ('stats_counters', dict(rate=1 / system_timestamp, count=1), system_timestamp, dict(name='gurm')),
+        ])
+
+    @statsd_setup(timestamps=range(1, 1000), tcp_local_host='127.0.0.1:0', stream_max_line_length=100)
+    def test_stream_listeners(self, statsd_module):
+        mock_pipe = statsd_module.dst_pipes[0]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            unix_stream_path = os.path.join(tmp_dir, 'statsd.sock')
+            statsd_module.cfg['unix_stream_path'] = unix_stream_path
+            assert statsd_module.init_stream_listeners()
+            tcp_listener = next(k.fileobj for k in statsd_module.stream_selector.get_map().values()
+                                if k.fileobj.family == socket.AF_INET)
+            tcp_client = socket.create_connection(tcp_listener.getsockname())
+            unix_client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            long_client = socket.create_connection(tcp_listener.getsockname())
+            try:
+                unix_client.connect(unix_stream_path)
+                # Lines split across sends, a malformed line and an unterminated last line
+                for data in (b"gorm:1|c\ngorm:", b"2|c\ngurm:\xff|c\ngu", b"rm:3|c\n", b"gurm:4|c"):
+                    tcp_client.sendall(data)
+                    unix_client.sendall(data)
+                long_client.sendall(b"x" * 200)
+                # The connection with the too long line gets closed
+                while statsd_module.stream_connections_accepted < 3 or len(statsd_module.stream_connections) > 2 or \
+                        sum(c['bytes_received'] for c in statsd_module.stream_connections.values()) < 2 * 44:
+                    statsd_module.stream_poll(1)
+                details = sorted(stats['lines_received'] for metadata, stats in statsd_module.stream_self_report())
+                assert details == [4, 4]
+                tcp_client.close()
+                unix_client.close()
+                while statsd_module.stream_connections:
+                    statsd_module.stream_poll(1)
+            finally:
+                for sock in (tcp_client, unix_client, long_client):
+                    sock.close()
+                statsd_module.close_stream_listeners()
+                statsd_module.remove_unix_socket_files()
+            assert not os.path.exists(unix_stream_path)
+        assert statsd_module.ingest_stats()['stream_connections_accepted'] == 3
+        statsd_module.last_timestamp = 0
+        statsd_module.tick()
+        system_timestamp = statsd_module.last_timestamp
+        statsd_verify(mock_pipe, [
+            ('stats_counters', dict(rate=6 / system_timestamp, count=6), system_timestamp, dict(name='gorm')),
+            ('stats_counters', dict(rate=14 / system_timestamp, count=14), system_timestamp, dict(name='gurm')),
+        ])
+
+    @statsd_setup(timestamps=range(1, 1000), percentile_thresholds=(50, 100),
+                  histogram_selector=lambda key: lambda x: 'test_histogram')
+    def test_merged_aggregates(self, statsd_module):
+        worker_module = statsd.StatsDServer('statsd_worker', statsd_module.cfg, [])
+        worker_module.init_cfg()
+        for m, values in ((statsd_module, (1, 2)), (worker_module, (3, 4))):
+            for v in values:
+                m.handle_line(0, "gorm:" + str(v) + "|ms")
+                m.handle_line(0, "gorm:" + str(v) + "|c")
+                m.handle_line(0, "gorm:" + str(v) + "|s")
+                m.handle_line(0, "gurm:" + str(v) + "|s")
+        worker_module.handle_line(0, "gorm:5|g")
+        worker_pipe = MagicMock()
+        worker_pipe.recv.return_value = (
+            worker_module.take_aggregates(), worker_module.ingest_stats(), worker_module.take_series_overflows()
+        )
+        statsd_module.worker_pipes = [worker_pipe]
+        assert not worker_module.timers and not worker_module.counters and not worker_module.sets
+        return [
+            ('stats_timers', dict(count=2, count_ps=2, lower=1, upper=2, mean=1.5, stdev=RoughFloat(0.71)),
+             1, dict(name='gorm', percentile='50.0')),
+            ('stats_timers', dict(count=4, count_ps=4, lower=1, upper=4, mean=2.5, stdev=RoughFloat(1.29)),
+             1, dict(name='gorm', percentile='100.0')),
+            ('stats_histograms', dict(count=4, count_ps=4, lower=1, upper=4, mean=2.5, stdev=RoughFloat(1.29)),
+             1, dict(name='gorm', histogram='test_histogram')),
+            ('stats_counters', dict(rate=10, count=10), 1, dict(name='gorm')),
+            ('stats_sets', dict(count=4), 1, dict(name='gorm')),
+            ('stats_sets', dict(count=4), 1, dict(name='gurm')),
+            ('stats_gauges', dict(value=5), 1, dict(name='gorm')),
+        ]
+
+    @statsd_setup(timestamps=range(1, 1000), histogram_selector=lambda key: lambda x: 'test_histogram')
+    def test_merged_histograms_detached(self, statsd_module):
+        # Worker histograms come without their selectors, they must not end up in the live maps.
+        mock_pipe = statsd_module.dst_pipes[0]
+        worker_module = statsd.StatsDServer('statsd_worker', statsd_module.cfg, [])
+        worker_module.init_cfg()
+        worker_module.handle_line(0, "gorm:1|ms")
+        worker_pipe = MagicMock()
+        worker_pipe.recv.return_value = (
+            worker_module.take_aggregates(), worker_module.ingest_stats(), worker_module.take_series_overflows()
+        )
+        statsd_module.worker_pipes = [worker_pipe]
+        statsd_module.tick()
+        statsd_verify(mock_pipe, [
+            ('stats_histograms', dict(count=1, count_ps=1, lower=1, upper=1, mean=1), 1,
+             dict(name='gorm', histogram='test_histogram')),
+        ])
+        assert not statsd_module.histograms and not statsd_module.timers
+        worker_pipe.recv.return_value = (({}, {}, {}, {}, {}), {}, {})
+        statsd_module.handle_line(0, "gorm:3|ms")
+        return [
+            ('stats_histograms', dict(count=1, count_ps=1, lower=3, upper=3, mean=3), 2,
+             dict(name='gorm', histogram='test_histogram')),
+        ]
+
+    @statsd_setup(timestamps=range(1, 100), percentile_thresholds=(100,), timer_engine='sketch',
+                  rollups=({'flush_interval': 2}, {'flush_interval': 3}))
+    def test_rollups(self, statsd_module):
+        mock_pipe = statsd_module.dst_pipes[0]
+        rollup_pipes = [MagicMock(), MagicMock()]
+        for rollup, rollup_pipe in zip(statsd_module.rollups, rollup_pipes):
+            rollup['dst_pipes'] = [rollup_pipe]
+        for i in range(1, 4):
+            statsd_module.handle_line(0, "gorm:" + str(i) + "|c")
+            statsd_module.handle_line(0, "gorm:" + str(i) + "|ms")
+            statsd_module.handle_line(0, "gorm:" + str(i) + "|s")
+            statsd_module.handle_line(0, "gurm:" + str(i) + "|g")
+            statsd_module.tick()
+            statsd_verify(mock_pipe, [
+                ('stats_counters', dict(rate=i, count=i), i, dict(name='gorm')),
+                ('stats_timers', dict(count=1, count_ps=1, lower=i, upper=RoughFloat(i), mean=i), i,
+                 dict(name='gorm', percentile='100.0')),
+                ('stats_sets', dict(count=1), i, dict(name='gorm')),
+                ('stats_gauges', dict(value=i), i, dict(name='gurm')),
+            ])
+        statsd_verify(rollup_pipes[0], [
+            ('stats_counters', dict(rate=1.5, count=3), 2, dict(name='gorm')),
+            ('stats_timers', dict(count=2, count_ps=1, lower=1, upper=RoughFloat(2), mean=1.5, stdev=RoughFloat(0.71)), 2,
+             dict(name='gorm', percentile='100.0')),
+            ('stats_sets', dict(count=2), 2, dict(name='gorm')),
+            ('stats_gauges', dict(value=2), 2, dict(name='gurm')),
+        ])
+        statsd_verify(rollup_pipes[1], [
+            ('stats_counters', dict(rate=2, count=6), 3, dict(name='gorm')),
+            ('stats_timers', dict(count=3, count_ps=1, lower=1, upper=RoughFloat(3), mean=2, stdev=RoughFloat(1)), 3,
+             dict(name='gorm', percentile='100.0')),
+            ('stats_sets', dict(count=3), 3, dict(name='gorm')),
+            ('stats_gauges', dict(value=3), 3, dict(name='gurm')),
+        ])
+
+    @statsd_setup(timestamps=(1.004, 1.998, 3.002, 4.001, 5.003), align_flush=True,
+                  rollups=({'flush_interval': 2}, {'flush_interval': 3}))
+    def test_aligned_rollups(self, statsd_module):
+        mock_pipe = statsd_module.dst_pipes[0]
+        rollup_pipes = [MagicMock(), MagicMock()]
+        for rollup, rollup_pipe in zip(statsd_module.rollups, rollup_pipes):
+            rollup['dst_pipes'] = [rollup_pipe]
+        for i in range(1, 5):
+            statsd_module.handle_line(0, "gorm:" + str(i) + "|c")
+            statsd_module.handle_line(0, "gurm:" + str(i) + "|g")
+            statsd_module.tick()
+            # Windows close on multiples of flush_interval, no matter how late or early the flush
+            statsd_verify(mock_pipe, [
+                ('stats_counters', dict(rate=i, count=i), i, dict(name='gorm')),
+                ('stats_gauges', dict(value=i), i, dict(name='gurm')),
+            ])
+            if i == 3:
+                statsd_verify(rollup_pipes[1], [
+                    ('stats_counters', dict(rate=2, count=6), 3, dict(name='gorm')),
+                    ('stats_gauges', dict(value=3), 3, dict(name='gurm')),
+                ])
+        statsd_verify(rollup_pipes[0], [
+            ('stats_counters', dict(rate=1.5, count=3), 2, dict(name='gorm')),
+            ('stats_gauges', dict(value=2), 2, dict(name='gurm')),
+            ('stats_counters', dict(rate=3.5, count=7), 4, dict(name='gorm')),
+            ('stats_gauges', dict(value=4), 4, dict(name='gurm')),
+        ])
+        statsd_verify(rollup_pipes[1], [])
+
     def prepare_performance_test(self):
         flag = os.environ.get('TEST_PERFORMANCE', 'no').lower()
         test_requested = flag in ('yes', 'true', '1')
@@ -808,6 +1314,14 @@ class TestStatsDServer(unittest.TestCase):
         self.metadata_performance(statsd_module, "histogram with 10 buckets, 10 tags", 'h', 100, 10, 1000, 10, prof)
         self.close_performance_test(prof)
 
+    @statsd_setup(timestamps=range(1, 10000000), percentile_thresholds=(90, 99),
+                  histogram_bins=(({}, (100, 200, 300, 400, 500, 600, 700, 800, 900)),))
+    def test_histogram_bins_performance10(self, statsd_module):
+        prof = self.prepare_performance_test()
+        self.metadata_performance(statsd_module, "histogram bins with 10 buckets, no tags", 'h', 100, 10, 1000, 0, prof)
+        self.metadata_performance(statsd_module, "histogram bins with 10 buckets, 10 tags", 'h', 100, 10, 1000, 10, prof)
+        self.close_performance_test(prof)
+
     def percentile_test_set(self, length, N=1):
         buf = []
         for i in range(N):
@@ -820,14 +1334,14 @@ class TestStatsDServer(unittest.TestCase):
         total_time, test_set = 0, self.percentile_test_set(vector_len, N)
         for i in range(M):
             statsd_module.buffer_metric = lambda bucket, stats, timestamp, metadata: None
-            statsd_module.timers.clear()
-            statsd_module.timers.update((k, (8, v)) for k, v in test_set)
+            timer_buffer = functools.partial(array.array, 'd') if statsd_module.timer_engine == 'numpy' else list
+            timers = {k: (8, timer_buffer(v)) for k, v in test_set}
             statsd_module.last_timestamp = 0
             statsd_module.current_timestamp = 10
             start_time = time.process_time()
             if profiler:
                 profiler.enable()
-            statsd_module.enqueue_timers(10)
+            statsd_module.enqueue_timers(10, 10, timers)
             if profiler:
                 profiler.disable()
             time_delta = time.process_time() - start_time
@@ -856,6 +1370,45 @@ class TestStatsDServer(unittest.TestCase):
         self.percentiles_performance(statsd_module, "3 percentiles, 10 vectors of 10000 samples", 10000, 10, 10, prof)
         self.close_performance_test(prof)
 
+    @statsd_setup(timestamps=range(1, 10000000), percentile_thresholds=(50, 90, 99), timer_engine='numpy')
+    def test_3percentiles_numpy_performance(self, statsd_module):
+        prof = self.prepare_performance_test()
+        self.percentiles_performance(statsd_module, "3 percentiles (numpy), 10000 vectors of 10 samples", 10, 10000, 10, prof)
+        self.percentiles_performance(statsd_module, "3 percentiles (numpy), 1000 vectors of 100 samples", 100, 1000, 10, prof)
+        self.percentiles_performance(statsd_module, "3 percentiles (numpy), 100 vectors of 1000 samples", 1000, 100, 10, prof)
+        self.percentiles_performance(statsd_module, "3 percentiles (numpy), 10 vectors of 10000 samples", 10000, 10, 10, prof)
+        self.close_performance_test(prof)
+
+    @statsd_setup(timestamps=range(1, 10000000), percentile_thresholds=(50, 90, 99), timer_engine='select')
+    def test_3percentiles_select_performance(self, statsd_module):
+        prof = self.prepare_performance_test()
+        self.percentiles_performance(statsd_module, "3 percentiles (select), 10000 vectors of 10 samples", 10, 10000, 10, prof)
+        self.percentiles_performance(statsd_module, "3 percentiles (select), 1000 vectors of 100 samples", 100, 1000, 10, prof)
+        self.percentiles_performance(statsd_module, "3 percentiles (select), 100 vectors of 1000 samples", 1000, 100, 10, prof)
+        self.percentiles_performance(statsd_module, "3 percentiles (select), 10 vectors of 10000 samples", 10000, 10, 10, prof)
+        self.close_performance_test(prof)
+
+    @statsd_setup(timestamps=range(1, 10000000), percentile_thresholds=(90, 100))
+    def test_select_vs_sort_performance(self, statsd_module):
+        prof = self.prepare_performance_test()
+        for vector_len in (10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7):
+            test_vector = self.rand_vec(length=vector_len)
+            for engine in ('sort', 'select'):
+                percentiles = getattr(statsd_module, engine + '_percentiles')
+                v = list(test_vector)
+                start_time = time.process_time()
+                if prof:
+                    prof.enable()
+                for t, stats in percentiles(v):
+                    pass
+                if prof:
+                    prof.disable()
+                time_delta = time.process_time() - start_time
+                print('\n{engine}: {vector_len:d} samples in {time_delta:.3f}s'.format(
+                    engine=engine, vector_len=vector_len, time_delta=time_delta
+                ), flush=True, file=sys.stderr)
+        self.close_performance_test(prof)
+
     @statsd_setup(timestamps=range(1, 10000000), percentile_thresholds=(10, 20, 30, 40, 50, 60, 70, 80, 90, 100))
     def test_10percentiles_performance(self, statsd_module):
         prof = self.prepare_performance_test()